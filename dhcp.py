@@ -1,14 +1,30 @@
 #!/usr/bin/python3
+"""List libvirt DHCP leases and add or delete static ip-dhcp-host entries in bulk.
 
+Importable: ``get_leases``, ``get_hosts``, ``select`` and ``delete_hosts``/``add_hosts``
+work on a network without going through the CLI.
+"""
+
+import argparse
+import fnmatch
 import logging
-import sys
 import shlex
 import subprocess
-from typing import List
+import sys
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Iterable, List, Optional, Sequence, Tuple
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 logger = logging.getLogger(__name__)
 
+# net-update commands sent through one virsh process (one libvirt connection)
+BATCH_SIZE = 16
+# echoed by virsh after every command of a batch, see _virsh_batch
+BATCH_MARKER = "dhcp.py:done"
+
 
 def run_command(cmd: str | list[str], _async: bool = False, _consol: bool = False) -> str:
     if isinstance(cmd, list):
@@ -28,27 +44,228 @@ def run_command(cmd: str | list[str], _async: bool = False, _consol: bool = Fals
             return completed.stdout.rstrip() if completed.stdout else ""
 
 
-def get_dhcpinfo() -> List[str]:
-    result = run_command("virsh --quiet net-dhcp-leases default")
+@dataclass(frozen=True)
+class Lease:
+    expiry: datetime
+    mac: str
+    ip: str
+    hostname: str
+
+    def __str__(self) -> str:
+        return f"{self.expiry:%Y-%m-%d %H:%M:%S}  {self.mac}  {self.ip:<16} {self.hostname}"
+
+
+@dataclass(frozen=True)
+class Host:
+    """A static ``<host mac= name= ip=/>`` entry of the network's DHCP range."""
+
+    mac: str
+    ip: str
+    name: str = ""
+
+    def xml(self) -> str:
+        name = f" name='{self.name}'" if self.name else ""
+        return f"<host mac='{self.mac}'{name} ip='{self.ip}' />"
+
+    def __str__(self) -> str:
+        return f"{self.mac}  {self.ip:<16} {self.name}"
+
+
+def get_dhcpinfo(network: str = "default") -> List[str]:
+    result = run_command(f"virsh --quiet net-dhcp-leases {network}")
     if result:
         return result.split("\n")
     return []
 
 
-dhcp_leases = get_dhcpinfo()
+def parse_lease(line: str) -> Optional[Lease]:
+    """Parse one ``virsh net-dhcp-leases`` row: date time mac protocol ip/prefix hostname [client-id]."""
+    fields = line.split()
+    if len(fields) < 6:
+        return None
+    try:
+        expiry = datetime.strptime(f"{fields[0]} {fields[1]}", "%Y-%m-%d %H:%M:%S")
+    except ValueError:
+        return None
+    return Lease(expiry, fields[2].lower(), fields[4].split("/")[0], fields[5] if fields[5] != "-" else "")
+
+
+def get_leases(network: str = "default") -> List[Lease]:
+    return [lease for line in get_dhcpinfo(network) if (lease := parse_lease(line))]
+
+
+def get_hosts(network: str = "default") -> List[Host]:
+    """Static host entries from the network definition."""
+    try:
+        root = ET.fromstring(run_command(f"virsh net-dumpxml {network}"))
+    except ET.ParseError as e:
+        logger.error("can't read network %s: %s", network, e)
+        return []
+    return [Host(h.get("mac", "").lower(), h.get("ip", ""), h.get("name", "")) for h in root.iterfind("./ip/dhcp/host") if h.get("mac")]
+
+
+def select(entries: Iterable, mac: Optional[str] = None, name: Optional[str] = None, expires_before: Optional[datetime] = None) -> list:
+    """Filter leases or hosts by MAC glob, hostname glob and (leases only) expiry."""
+    chosen = []
+    for entry in entries:
+        hostname = entry.hostname if isinstance(entry, Lease) else entry.name
+        if mac and not fnmatch.fnmatch(entry.mac, mac.lower()):
+            continue
+        if name and not fnmatch.fnmatch(hostname, name):
+            continue
+        if expires_before and not (isinstance(entry, Lease) and entry.expiry < expires_before):
+            continue
+        chosen.append(entry)
+    return chosen
+
+
+def _virsh_batch(batch: Sequence[Tuple[Host, str]]) -> List[Host]:
+    """Run several virsh commands over one connection; returns the hosts whose command failed.
+
+    virsh carries on after a failed command and exits with the status of the
+    last one, so every command is followed by an ``echo`` of ``BATCH_MARKER``.
+    A command that succeeded printed its confirmation to stdout before its
+    marker; errors only go to stderr.
+    """
+    script = " ; ".join(f"{command} ; echo {BATCH_MARKER}" for _, command in batch)
+    completed = subprocess.run(["virsh", script], stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    outputs: List[List[str]] = [[]]
+    for line in completed.stdout.splitlines():
+        if line.strip() == BATCH_MARKER:
+            outputs.append([])
+        elif line.strip():
+            outputs[-1].append(line)
+    failed = [host for i, (host, _) in enumerate(batch) if i >= len(outputs) - 1 or not outputs[i]]
+    errors = [line.strip() for line in completed.stderr.splitlines() if line.startswith("error:")]
+    if (errors or completed.returncode) and not failed:
+        failed = [host for host, _ in batch]
+    if failed:
+        logger.error("virsh batch failed (%d): %s", completed.returncode, " ".join(errors) or completed.stderr.strip())
+        for host in failed:
+            logger.error("net-update failed for %s", host.xml())
+    return failed
+
 
-if len(dhcp_leases) > 0 and len(sys.argv) > 1:
+def update_hosts(action: str, hosts: Sequence[Host], network: str = "default", jobs: int = 4, dry_run: bool = False) -> bool:
+    """``net-update NETWORK add|delete ip-dhcp-host`` for every host, live and persistent.
+
+    Commands go out in batches of ``BATCH_SIZE`` per virsh process, with at most
+    *jobs* processes at a time, instead of one process per host.  Returns False
+    if any host's command failed.
+    """
+    commands = [(host, f'net-update {network} {action} ip-dhcp-host "{host.xml()}" --live --config') for host in hosts]
+    if dry_run or not commands:
+        for _, cmd in commands:
+            print(f"virsh {cmd}")
+        return True
+    batches = [commands[i : i + BATCH_SIZE] for i in range(0, len(commands), BATCH_SIZE)]
+    with ThreadPoolExecutor(max(1, min(jobs, len(batches)))) as pool:
+        return not any(pool.map(_virsh_batch, batches))
+
+
+def delete_hosts(hosts: Sequence[Host], network: str = "default", jobs: int = 4, dry_run: bool = False) -> bool:
+    return update_hosts("delete", hosts, network, jobs, dry_run)
+
+
+def add_hosts(hosts: Sequence[Host], network: str = "default", jobs: int = 4, dry_run: bool = False) -> bool:
+    return update_hosts("add", hosts, network, jobs, dry_run)
+
+
+def parse_host(text: str) -> Host:
+    """argparse type for ``MAC,IP[,NAME]``."""
+    parts = text.split(",")
+    if len(parts) not in (2, 3):
+        raise argparse.ArgumentTypeError("expected MAC,IP[,NAME]")
+    return Host(parts[0].lower(), parts[1], parts[2] if len(parts) == 3 else "")
+
+
+def parse_time(text: str) -> datetime:
+    try:
+        return datetime.fromisoformat(text)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(f"expected an ISO date/time: {e}") from e
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="libvirt DHCP leases and static hosts")
+    parser.add_argument("--network", "-n", default="default", help="libvirt network")
+    sub = parser.add_subparsers(dest="command")
+
+    filters = argparse.ArgumentParser(add_help=False)
+    filters.add_argument("--mac", help="MAC address glob, e.g. '52:54:00:*'")
+    filters.add_argument("--name", help="Hostname glob")
+    filters.add_argument("--expires-before", type=parse_time, metavar="TIME", help="Only leases expiring before TIME (ISO format)")
+    filters.add_argument("--expired", action="store_true", help="Only static hosts without an active lease (libvirt never lists expired leases)")
+
+    p = sub.add_parser("list", parents=[filters], help="Show leases (default) or static hosts")
+    p.add_argument("--hosts", action="store_true", help="List static ip-dhcp-host entries instead of leases")
+
+    p = sub.add_parser("delete", parents=[filters], help="Delete matching static hosts")
+    p.add_argument("--all", action="store_true", help="Delete every static host (required when no filter is given)")
+    p.add_argument("--jobs", "-j", type=int, default=4, help="Parallel virsh processes")
+    p.add_argument("--dry-run", action="store_true", help="Print the net-update commands only")
+
+    p = sub.add_parser("add", help="Add static hosts")
+    p.add_argument("hosts", nargs="+", type=parse_host, metavar="MAC,IP[,NAME]")
+    p.add_argument("--jobs", "-j", type=int, default=4, help="Parallel virsh processes")
+    p.add_argument("--dry-run", action="store_true", help="Print the net-update commands only")
+    return parser
+
+
+def delete_by_index(idx: int, network: str = "default") -> None:
+    """Legacy ``dhcp.py N``: delete the static host of the N-th lease."""
+    dhcp_leases = get_dhcpinfo(network)
     try:
-        idx = int(sys.argv[1])
         dhcp_info = dhcp_leases[idx].split()
         dest_str = f"<host mac='{dhcp_info[2]}' name='{dhcp_info[5]}' ip='{dhcp_info[4].split('/')[0]}' />"
-        cmd = f'virsh net-update default delete ip-dhcp-host "{dest_str}" --live --config'
+        cmd = f'virsh net-update {network} delete ip-dhcp-host "{dest_str}" --live --config'
         print(cmd)
         run_command(cmd)
     except (IndexError, ValueError) as e:
         print(f"Error: {e}. Check the index and input.")
     except Exception as e:
         print(f"Unexpected error: {e}")
-else:
-    for dhcp in dhcp_leases:
-        print(dhcp)
+
+
+def main(argv: Optional[Sequence[str]] = None) -> int:
+    argv = list(sys.argv[1:] if argv is None else argv)
+    if len(argv) == 1 and argv[0].lstrip("-").isdigit():
+        delete_by_index(int(argv[0]))
+        return 0
+    args = build_parser().parse_args(argv)
+    command = args.command or "list"
+    if command == "add":
+        return 0 if add_hosts(args.hosts, args.network, args.jobs, args.dry_run) else 1
+
+    # plain "dhcp.py" has no subcommand and so none of the filter options
+    mac, name, expires_before = getattr(args, "mac", None), getattr(args, "name", None), getattr(args, "expires_before", None)
+    expired = getattr(args, "expired", False)
+    if command == "delete" and not (mac or name or expires_before or expired or args.all):
+        logger.error("refusing to delete every static host; give a filter or --all")
+        return 2
+    leases = get_leases(args.network)
+    if command == "list" and not (getattr(args, "hosts", False) or expired):
+        for lease in select(leases, mac, name, expires_before):
+            print(lease)
+        return 0
+
+    hosts = select(get_hosts(args.network), mac, name)
+    if expires_before:
+        stale = {lease.mac for lease in select(leases, expires_before=expires_before)}
+        hosts = [host for host in hosts if host.mac in stale]
+    if expired:
+        active = {lease.mac for lease in leases}
+        hosts = [host for host in hosts if host.mac not in active]
+    if command == "list":
+        for host in hosts:
+            print(host)
+        return 0
+    if not hosts:
+        logger.info("no matching hosts")
+        return 0
+    logger.info("deleting %d host(s) from %s", len(hosts), args.network)
+    return 0 if delete_hosts(hosts, args.network, args.jobs, args.dry_run) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
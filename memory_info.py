@@ -3,78 +3,379 @@
 Utility to get accurate memory information on Linux systems.
 """
 
+import argparse
+import csv
+import json
 import os
+import sys
+import time
+from collections import deque
 
+MEMINFO = '/proc/meminfo'
+# /proc/meminfo is ~1.5 KB; one pread of this size always gets all of it
+MEMINFO_READ_SIZE = 8192
+CGROUP_ROOT = '/sys/fs/cgroup'
+PRESSURE_MEMORY = '/proc/pressure/memory'
+HUGEPAGES_SYSFS = '/sys/kernel/mm/hugepages'
+GIB = 1024 ** 3
+# memory pressure (PSI avg10, percent) above which recommendations are halved
+PRESSURE_SOME_LIMIT = 20.0
+PRESSURE_FULL_LIMIT = 5.0
+DEFAULT_SAMPLE_FIELDS = ('MemTotal', 'MemAvailable', 'MemFree', 'Cached', 'Committed_AS', 'AnonHugePages', 'HugePages_Free')
+
+
+def parse_meminfo(data, fields=None):
+    """Parse the text of /proc/meminfo in one pass.
+
+    Args:
+        data: Raw file contents (bytes).
+        fields: Optional set of field names to keep; all fields when None.
 
-def get_available_memory():
-    """Get available memory in bytes by reading /proc/meminfo.
-    
     Returns:
-        int: Available memory in bytes, or 0 if unable to read.
+        dict: Field name to value. ``kB`` values are converted to bytes,
+        unitless ones (``HugePages_*``) are kept as counts.
+    """
+    info = {}
+    for line in data.split(b'\n'):
+        name, sep, rest = line.partition(b':')
+        if not sep:
+            continue
+        key = name.decode()
+        if fields is not None and key not in fields:
+            continue
+        parts = rest.split()
+        if not parts:
+            continue
+        value = int(parts[0])
+        info[key] = value * 1024 if len(parts) > 1 and parts[1] == b'kB' else value
+    return info
+
+
+def read_meminfo(path=MEMINFO):
+    """Read every /proc/meminfo field in a single open and read.
+
+    Returns:
+        dict: Field name to value (bytes, or a count for ``HugePages_*``),
+        empty if the file can't be read.
     """
     try:
-        with open('/proc/meminfo', 'r') as f:
-            for line in f:
-                if line.startswith('MemAvailable:'):
-                    # Extract the number (in kB) and convert to bytes
-                    mem_available_kb = int(line.split()[1])
-                    return mem_available_kb * 1024
-    except (FileNotFoundError, ValueError, IndexError):
-        pass
-    
-    # Fallback to the original method if /proc/meminfo is not available
+        with open(path, 'rb') as f:
+            return parse_meminfo(f.read())
+    except (OSError, ValueError):
+        return {}
+
+
+def _sysconf_bytes(pages_name):
     try:
-        page_size = os.sysconf('SC_PAGE_SIZE')
-        avail_phys_pages = os.sysconf('SC_AVPHYS_PAGES')
-        return page_size * avail_phys_pages
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf(pages_name)
     except (ValueError, OSError):
         return 0
 
 
-def get_total_memory():
+def get_available_memory(meminfo=None):
+    """Get available memory in bytes by reading /proc/meminfo.
+
+    Returns:
+        int: Available memory in bytes, or 0 if unable to read.
+    """
+    meminfo = read_meminfo() if meminfo is None else meminfo
+    if 'MemAvailable' in meminfo:
+        return meminfo['MemAvailable']
+    # Fallback to the original method if /proc/meminfo is not available
+    return _sysconf_bytes('SC_AVPHYS_PAGES')
+
+
+def get_total_memory(meminfo=None):
     """Get total memory in bytes by reading /proc/meminfo.
-    
+
     Returns:
         int: Total memory in bytes, or 0 if unable to read.
     """
-    try:
-        with open('/proc/meminfo', 'r') as f:
-            for line in f:
-                if line.startswith('MemTotal:'):
-                    # Extract the number (in kB) and convert to bytes
-                    mem_total_kb = int(line.split()[1])
-                    return mem_total_kb * 1024
-    except (FileNotFoundError, ValueError, IndexError):
-        pass
-    
+    meminfo = read_meminfo() if meminfo is None else meminfo
+    if 'MemTotal' in meminfo:
+        return meminfo['MemTotal']
     # Fallback to sysconf method
-    try:
-        page_size = os.sysconf('SC_PAGE_SIZE')
-        phys_pages = os.sysconf('SC_PHYS_PAGES')
-        return page_size * phys_pages
-    except (ValueError, OSError):
-        return 0
+    return _sysconf_bytes('SC_PHYS_PAGES')
 
 
 def get_memory_info():
-    """Get comprehensive memory information.
-    
+    """Get comprehensive memory information from one consistent snapshot.
+
     Returns:
         dict: Dictionary containing memory information in bytes.
     """
+    meminfo = read_meminfo()
+    total = get_total_memory(meminfo)
+    available = get_available_memory(meminfo)
     return {
-        'available': get_available_memory(),
-        'total': get_total_memory(),
-        'used': get_total_memory() - get_available_memory() if get_total_memory() > 0 else 0
+        'available': available,
+        'total': total,
+        'used': total - available if total > 0 else 0
     }
 
 
+def read_cgroup_memory(proc='self'):
+    """Tightest cgroup v2 memory limit on the path of *proc*'s cgroup.
+
+    Returns:
+        dict: ``limit``, ``current`` and ``headroom`` in bytes for the ancestor
+        with the least headroom, or an empty dict when no ancestor has a
+        limit (or the host is not on cgroup v2).
+    """
+    try:
+        with open(f'/proc/{proc}/cgroup') as f:
+            path = next(line[3:].strip() for line in f if line.startswith('0::'))
+    except (OSError, StopIteration):
+        return {}
+    best = {}
+    parts = [p for p in path.split('/') if p]
+    for depth in range(len(parts), -1, -1):
+        base = os.path.join(CGROUP_ROOT, *parts[:depth])
+        try:
+            with open(os.path.join(base, 'memory.max')) as f:
+                raw = f.read().strip()
+            with open(os.path.join(base, 'memory.current')) as f:
+                current = int(f.read())
+        except (OSError, ValueError):
+            continue
+        if raw == 'max':
+            continue
+        limit = int(raw)
+        if not best or limit - current < best['headroom']:
+            best = {'limit': limit, 'current': current, 'headroom': max(0, limit - current)}
+    return best
+
+
+def read_pressure(path=PRESSURE_MEMORY):
+    """Memory PSI as ``{'some': {'avg10': ..., ...}, 'full': {...}}``; empty without PSI."""
+    pressure = {}
+    try:
+        with open(path) as f:
+            for line in f:
+                kind, *fields = line.split()
+                pressure[kind] = {k: float(v) for k, v in (field.split('=') for field in fields)}
+    except (OSError, ValueError):
+        return {}
+    return pressure
+
+
+def hugepage_pool(meminfo=None, page_size=None):
+    """Hugepage pool in bytes: ``{'page', 'total', 'free'}``.
+
+    Args:
+        meminfo: Parsed /proc/meminfo, read when None.
+        page_size: Page size in bytes; None for the default ``Hugepagesize``.
+            Other sizes (1G on a 2M host) only appear in sysfs.
+    """
+    meminfo = read_meminfo() if meminfo is None else meminfo
+    default = meminfo.get('Hugepagesize', 0)
+    if page_size is None or page_size == default:
+        return {'page': default, 'total': meminfo.get('HugePages_Total', 0) * default, 'free': meminfo.get('HugePages_Free', 0) * default}
+    base = os.path.join(HUGEPAGES_SYSFS, f'hugepages-{page_size // 1024}kB')
+    counts = []
+    for name in ('nr_hugepages', 'free_hugepages'):
+        try:
+            with open(os.path.join(base, name)) as f:
+                counts.append(int(f.read()))
+        except (OSError, ValueError):
+            counts.append(0)
+    return {'page': page_size, 'total': counts[0] * page_size, 'free': counts[1] * page_size}
+
+
+def parse_guest_size(text):
+    """Size of a QEMU ``-m`` argument (``6G``, ``size=4096M,slots=2``, ``2048``) in bytes."""
+    for part in text.split(','):
+        key, sep, value = part.partition('=')
+        value = value if sep else key
+        if sep and key != 'size':
+            continue
+        unit = value[-1:].upper()
+        scale = {'K': 1024, 'M': 1024 ** 2, 'G': GIB, 'T': 1024 ** 4}.get(unit)
+        try:
+            return int(float(value[:-1] if scale else value) * (scale or 1024 ** 2))
+        except ValueError:
+            return 0
+    return 0
+
+
+def committed_guest_memory(balloons=None):
+    """Guest RAM that running QEMU processes may still fault in.
+
+    For each ``qemu-system-*`` process this is its ``-m`` size, or its
+    balloon target when one is known, minus what is already resident:
+    ``VmRSS`` is already out of MemAvailable, and ``HugetlbPages`` of
+    hugepage-backed guests come from the hugepage pool, which never was in it.
+
+    Args:
+        balloons: Optional dict of pid to the guest's balloon target in bytes.
+
+    Returns:
+        dict: pid to outstanding bytes.
+    """
+    balloons = balloons or {}
+    committed = {}
+    for entry in os.scandir('/proc'):
+        if not entry.name.isdigit():
+            continue
+        pid = int(entry.name)
+        try:
+            with open(f'/proc/{pid}/cmdline', 'rb') as f:
+                argv = f.read().split(b'\0')
+            if not os.path.basename(argv[0]).startswith(b'qemu-system'):
+                continue
+            size = parse_guest_size(argv[argv.index(b'-m') + 1].decode()) if b'-m' in argv else 0
+            with open(f'/proc/{pid}/status') as f:
+                resident = sum(int(line.split()[1]) * 1024 for line in f if line.startswith(('VmRSS:', 'HugetlbPages:')))
+        except (OSError, IndexError):
+            continue
+        if balloons.get(pid):
+            size = min(size, balloons[pid])
+        committed[pid] = max(0, size - resident)
+    return committed
+
+
+def recommend_guest_memory(minimum=6 * GIB, maximum=16 * GIB, pending=0, hugepages=False, grow_pool=False, balloons=None):
+    """Recommend a guest RAM size that still fits next to everything else on the host.
+
+    The budget starts from MemAvailable, minus RAM other running guests may
+    still fault in, capped by the tightest cgroup limit, less a host reserve.
+    Hugepage guests get the free pool of their page size instead, plus that
+    normal-page budget when the pool will be grown (*grow_pool*). *pending*
+    bytes promised to guests that are being started come off either way, and
+    the result is halved when memory PSI shows the host is reclaiming hard.
+
+    Args:
+        hugepages: False for normal pages, True for the default hugepage size,
+            or the hugepage size in bytes.
+        grow_pool: The caller reserves missing hugepages out of normal memory.
+        balloons: pid to balloon target in bytes of running guests, see
+            ``committed_guest_memory``.
+
+    Returns:
+        dict: ``size`` (whole GiB, clamped to [minimum, maximum]), the
+        ``budget`` it came from, and the inputs behind it.
+    """
+    meminfo = read_meminfo()
+    total = get_total_memory(meminfo)
+    pool = hugepage_pool(meminfo, None if isinstance(hugepages, bool) else hugepages)
+    available = get_available_memory(meminfo)
+    guests = sum(committed_guest_memory(balloons).values()) if not hugepages or grow_pool else 0
+    cgroup = read_cgroup_memory()
+    pressure = read_pressure()
+    reserve = max(GIB, total // 20) if not hugepages or grow_pool else 0
+    normal = available - guests
+    if cgroup:
+        normal = min(normal, cgroup['headroom'])
+    normal -= reserve
+    if hugepages:
+        budget = pool['free'] + (max(normal, 0) if grow_pool else 0) - pending
+    else:
+        budget = normal - pending
+    stressed = pressure.get('some', {}).get('avg10', 0) > PRESSURE_SOME_LIMIT or pressure.get('full', {}).get('avg10', 0) > PRESSURE_FULL_LIMIT
+    if stressed:
+        budget //= 2
+    size = min(max(budget // GIB * GIB, minimum), maximum)
+    return {
+        'size': size,
+        'budget': budget,
+        'constrained': budget < minimum,
+        'available': available,
+        'committed_guests': guests,
+        'pending': pending,
+        'reserve': reserve,
+        'cgroup': cgroup,
+        'pressure': pressure,
+        'hugepages': pool,
+    }
+
+
+class MeminfoSampler:
+    """Sample selected /proc/meminfo fields at a fixed rate.
+
+    The file stays open and every sample is a single ``pread`` at offset 0,
+    so sampling costs one syscall plus a short parse. The most recent
+    ``capacity`` samples are kept in a ring buffer.
+    """
+
+    def __init__(self, fields=DEFAULT_SAMPLE_FIELDS, hz=10.0, capacity=4096, path=MEMINFO):
+        self.fields = tuple(fields)
+        self.wanted = set(self.fields)
+        self.interval = 1.0 / hz
+        self.samples = deque(maxlen=capacity)
+        self.fd = os.open(path, os.O_RDONLY)
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def sample(self):
+        """Take one sample and append it to the ring buffer.
+
+        Returns:
+            tuple: ``(timestamp, value, ...)`` in ``self.fields`` order.
+        """
+        info = parse_meminfo(os.pread(self.fd, MEMINFO_READ_SIZE, 0), self.wanted)
+        row = (time.time(), *(info.get(name, 0) for name in self.fields))
+        self.samples.append(row)
+        return row
+
+    def run(self, duration=None, count=None, sink=None):
+        """Sample until *duration* seconds or *count* samples, whichever comes first.
+
+        Ticks are scheduled on absolute deadlines, so a slow write does not
+        shift later samples. *sink* is called with every row as it is taken.
+        """
+        start = time.monotonic()
+        taken = 0
+        while (count is None or taken < count) and (duration is None or time.monotonic() - start < duration):
+            row = self.sample()
+            taken += 1
+            if sink:
+                sink(row)
+            delay = start + taken * self.interval - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        return taken
+
+
+def row_writer(fmt, fields, out=sys.stdout):
+    """Return a callable that streams sample rows to *out* as csv, json lines or text."""
+    columns = ('time',) + tuple(fields)
+    if fmt == 'csv':
+        writer = csv.writer(out)
+        writer.writerow(columns)
+
+        def write(row):
+            writer.writerow((f'{row[0]:.3f}',) + row[1:])
+            out.flush()
+    elif fmt == 'json':
+        def write(row):
+            out.write(json.dumps(dict(zip(columns, (round(row[0], 3),) + row[1:]))) + '\n')
+            out.flush()
+    else:
+        out.write(' '.join(f'{c:>14}' for c in columns) + '\n')
+
+        def write(row):
+            values = [time.strftime('%H:%M:%S', time.localtime(row[0])) + f'.{int(row[0] * 1000) % 1000:03d}']
+            values += [format_bytes(v) if not f.startswith('HugePages_') else str(v) for f, v in zip(fields, row[1:])]
+            out.write(' '.join(f'{v:>14}' for v in values) + '\n')
+            out.flush()
+    return write
+
+
 def format_bytes(bytes_value):
     """Format bytes into human readable format.
-    
+
     Args:
         bytes_value: Number of bytes
-        
+
     Returns:
         str: Formatted string (e.g., "4.2 GB")
     """
@@ -85,17 +386,61 @@ def format_bytes(bytes_value):
     return f"{bytes_value:.1f} PB"
 
 
-if __name__ == "__main__":
-    # Test the functions
+def print_summary():
     print("Memory Information:")
     print("-" * 30)
-    
+
     mem_info = get_memory_info()
-    
+
     print(f"Total:     {format_bytes(mem_info['total'])}")
     print(f"Available: {format_bytes(mem_info['available'])}")
     print(f"Used:      {format_bytes(mem_info['used'])}")
-    
+
     if mem_info['total'] > 0:
         usage_percent = (mem_info['used'] / mem_info['total']) * 100
-        print(f"Usage:     {usage_percent:.1f}%")
\ No newline at end of file
+        print(f"Usage:     {usage_percent:.1f}%")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Host memory summary, or a /proc/meminfo sampler with --hz')
+    parser.add_argument('--all', action='store_true', help='Print every /proc/meminfo field')
+    parser.add_argument('--recommend', action='store_true', help='Show the guest RAM size qemu.py would pick and why')
+    parser.add_argument('--hz', type=float, help='Sample at this rate (e.g. 10-100) instead of printing a summary')
+    parser.add_argument('--fields', default=','.join(DEFAULT_SAMPLE_FIELDS), help='Comma separated meminfo fields to sample')
+    parser.add_argument('--format', default='text', choices=['text', 'csv', 'json'], help='Sample output format (json = one object per line)')
+    parser.add_argument('--duration', type=float, help='Stop after this many seconds')
+    parser.add_argument('--count', type=int, help='Stop after this many samples')
+    parser.add_argument('--buffer', type=int, default=4096, help='Samples kept in memory')
+    args = parser.parse_args(argv)
+
+    if args.all:
+        for name, value in read_meminfo().items():
+            print(f"{name + ':':<18}{value if name.startswith('HugePages_') else format_bytes(value):>12}")
+        return
+    if args.recommend:
+        rec = recommend_guest_memory()
+        print(f"Recommended guest size: {rec['size'] // GIB}G" + (' (host is short of memory)' if rec['constrained'] else ''))
+        print(f"  budget            {format_bytes(max(rec['budget'], 0))}")
+        print(f"  available         {format_bytes(rec['available'])}")
+        print(f"  running guests    {format_bytes(rec['committed_guests'])} not yet resident")
+        print(f"  host reserve      {format_bytes(rec['reserve'])}")
+        if rec['cgroup']:
+            print(f"  cgroup            {format_bytes(rec['cgroup']['current'])} of {format_bytes(rec['cgroup']['limit'])}")
+        if rec['pressure']:
+            print(f"  PSI avg10         some {rec['pressure']['some']['avg10']:.1f}%  full {rec['pressure'].get('full', {}).get('avg10', 0):.1f}%")
+        if rec['hugepages']['total']:
+            print(f"  hugepages         {format_bytes(rec['hugepages']['free'])} free of {format_bytes(rec['hugepages']['total'])}")
+        return
+    if not args.hz:
+        print_summary()
+        return
+    fields = [f.strip() for f in args.fields.split(',') if f.strip()]
+    with MeminfoSampler(fields, args.hz, args.buffer) as sampler:
+        try:
+            sampler.run(args.duration, args.count, row_writer(args.format, fields))
+        except (KeyboardInterrupt, BrokenPipeError):
+            pass
+
+
+if __name__ == "__main__":
+    main()
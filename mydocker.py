@@ -3,14 +3,21 @@
 
 import argparse
 import fnmatch
+import http.client
+import json
 import logging
 import os
 import platform
 import shlex
+import socket
 import subprocess
 import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from pathlib import Path
 from typing import Any
+from urllib.parse import quote, urlencode
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
 logger = logging.getLogger(__name__)
@@ -40,39 +47,422 @@ def run_command(cmd, *, capture: bool = True, console: bool = False, async_: boo
     return ""
 
 
-# -- helpers ---------------------------------------------------------------
+# -- Docker Engine API ------------------------------------------------------
+
+DOCKER_SOCKET = "/var/run/docker.sock"
+# states `docker ps` (without -a) lists
+RUNNING_STATES = ("running", "paused", "restarting")
+
+
+class DockerAPIError(Exception):
+    def __init__(self, status: int, message: str) -> None:
+        super().__init__(f"{status}: {message}")
+        self.status = status
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """HTTP/1.1 connection to a unix socket; http.client keeps it alive between requests."""
+
+    def __init__(self, socket_path: str, timeout: float = 10.0) -> None:
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self) -> None:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.socket_path)
+        except OSError:
+            sock.close()
+            raise
+        self.sock = sock
+
+
+def docker_socket() -> str | None:
+    """Daemon socket from DOCKER_HOST (unix:// only) or the default path; None means use the CLI."""
+    host = os.environ.get("DOCKER_HOST", "")
+    if host and not host.startswith("unix://"):
+        return None
+    path = host[len("unix://") :] if host else DOCKER_SOCKET
+    return path if os.path.exists(path) else None
+
+
+class DockerAPI:
+    """Minimal Docker Engine API client: JSON requests over a kept-alive unix socket connection.
+
+    Each thread gets its own connection, so parallel lookups don't interleave on one socket.
+    """
+
+    def __init__(self, socket_path: str, timeout: float = 10.0) -> None:
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self._local = threading.local()
+        self._conns: list[UnixHTTPConnection] = []  # every thread's, so close() reaches them all
+        self._lock = threading.Lock()
+
+    @property
+    def conn(self) -> UnixHTTPConnection:
+        if not hasattr(self._local, "conn"):
+            self._local.conn = UnixHTTPConnection(self.socket_path, self.timeout)
+            with self._lock:
+                self._conns.append(self._local.conn)
+        return self._local.conn
+
+    def request(self, method: str, endpoint: str, **query: Any) -> Any:
+        url = endpoint + (f"?{urlencode(query)}" if query else "")
+        for attempt in range(2):
+            try:
+                self.conn.request(method, url)
+                resp = self.conn.getresponse()
+                data = resp.read()
+                break
+            except ConnectionError:
+                # the daemon may drop an idle keep-alive connection; reconnect once
+                self.conn.close()
+                if attempt:
+                    raise
+        if resp.status >= 400:
+            try:
+                message = json.loads(data).get("message", "")
+            except ValueError:
+                message = data.decode(errors="replace").strip()
+            raise DockerAPIError(resp.status, message or resp.reason)
+        return json.loads(data) if data else None
+
+    def get(self, endpoint: str, **query: Any) -> Any:
+        return self.request("GET", endpoint, **query)
+
+    def close(self) -> None:
+        with self._lock:
+            conns = list(self._conns)
+        for conn in conns:
+            conn.close()
+
+
+@dataclass(frozen=True)
+class Container:
+    id: str
+    name: str
+    image: str
+    state: str
+
+    @property
+    def short_id(self) -> str:
+        return self.id[:12]
+
+    @property
+    def running(self) -> bool:
+        return self.state in RUNNING_STATES
+
+    @classmethod
+    def from_api(cls, data: dict) -> "Container":
+        names = [n.lstrip("/") for n in data.get("Names") or []]
+        # linked containers also carry "other/alias" names
+        name = next((n for n in names if "/" not in n), names[0] if names else "")
+        return cls(data["Id"], name, data.get("Image", ""), data.get("State", ""))
+
+    @classmethod
+    def from_cli(cls, data: dict) -> "Container":
+        state = data.get("State") or ("running" if data.get("Status", "").startswith("Up") else "exited")
+        return cls(data["ID"], data.get("Names", "").split(",")[0], data.get("Image", ""), state)
+
+
+@dataclass(frozen=True)
+class Image:
+    """One repository of an image; like `docker images`, a multi-tagged image appears once per tag."""
+
+    id: str
+    repository: str
+
+    @property
+    def short_id(self) -> str:
+        return self.id.removeprefix("sha256:")[:12]
+
+
+class Inventory:
+    """Every container and image from one listing each, answering lookups until invalidated.
+
+    Lists come from the Engine API on the daemon socket, or from one
+    `docker ps -a`/`docker images` each when the socket isn't usable.
+    """
+
+    def __init__(self, socket_path: str | None = None) -> None:
+        socket_path = socket_path or docker_socket()
+        self.api: DockerAPI | None = DockerAPI(socket_path) if socket_path else None
+        self._containers: list[Container] | None = None
+        self._images: list[Image] | None = None
+        # inspect JSON per (kind, name); kept for the whole run, since objects rarely change under us
+        self._inspected: dict[tuple[str, str], dict | None] = {}
+
+    def invalidate(self) -> None:
+        self._containers = self._images = None
+
+    def _api_get(self, endpoint: str, **query: Any) -> Any:
+        """GET through the API; None (and CLI from then on) if the daemon can't be reached."""
+        api = self.api  # another thread may drop self.api at any time
+        if not api:
+            return None
+        try:
+            return api.get(endpoint, **query)
+        except (OSError, http.client.HTTPException, DockerAPIError, ValueError) as e:
+            self._disable_api(e)
+            return None
+
+    def _disable_api(self, error: Exception) -> None:
+        logger.debug("docker API unavailable (%s), falling back to the CLI", error)
+        api, self.api = self.api, None
+        if api:
+            api.close()
+
+    @staticmethod
+    def _cli_rows(cmd: str) -> list[dict]:
+        rows = []
+        for line in run_command(cmd).splitlines():
+            try:
+                rows.append(json.loads(line))
+            except ValueError:
+                logger.debug("unexpected docker output: %s", line)
+        return rows
+
+    @property
+    def containers(self) -> list[Container]:
+        if self._containers is None:
+            data = self._api_get("/containers/json", all=1)
+            if data is not None:
+                found = [Container.from_api(c) for c in data]
+            else:
+                found = [Container.from_cli(c) for c in self._cli_rows("docker ps -a --no-trunc --format '{{json .}}'")]
+            self._containers = sorted(found, key=lambda c: c.name)
+        return self._containers
+
+    @property
+    def images(self) -> list[Image]:
+        if self._images is None:
+            data = self._api_get("/images/json")
+            if data is not None:
+                found = [Image(i["Id"], tag.rsplit(":", 1)[0]) for i in data for tag in i.get("RepoTags") or ["<none>:<none>"]]
+            else:
+                found = [Image(i["ID"], i.get("Repository", "")) for i in self._cli_rows("docker images --no-trunc --format '{{json .}}'")]
+            self._images = sorted(found, key=lambda i: i.repository)
+        return self._images
 
+    def image(self, name: str) -> Image | None:
+        """Image whose repository, repository:tag or short ID is *name*."""
+        repo = name.rsplit(":", 1)[0] if ":" in name.rsplit("/", 1)[-1] else name
+        return next((i for i in self.images if i.repository in (name, repo) or i.short_id == name), None)
 
-def _docker_list(format_str: str, filter_expr: str = "") -> list[str]:
-    """Return sorted output for docker query."""
+    def container(self, name: str) -> Container | None:
+        """Container named exactly *name*."""
+        return next((c for c in self.containers if c.name == name), None)
 
-    out = run_command(f"docker {filter_expr} --format '{format_str}'")
-    return sorted(out.splitlines()) if out else []
+    def find_containers(self, pattern: str) -> list[Container]:
+        return [c for c in self.containers if fnmatch.fnmatch(c.name, pattern)]
+
+    def containers_of(self, image: str) -> list[str]:
+        """Names of containers created from *image* or its descendants (`--filter ancestor=`)."""
+        data = self._api_get("/containers/json", all=1, filters=json.dumps({"ancestor": [image]}))
+        if data is None:
+            return sorted(run_command(f"docker ps -a --filter 'ancestor={image}' --format '{{{{.Names}}}}'").splitlines())
+        return sorted(Container.from_api(c).name for c in data)
+
+    def inspect(self, kind: str, name: str) -> dict | None:
+        """``docker inspect`` JSON of a container or image (*kind*), fetched once per process.
+
+        Containers are inspected with sizes (SizeRw/SizeRootFs). None if there's no such object.
+        """
+        key = (kind, name)
+        if key in self._inspected:
+            return self._inspected[key]
+        data = None
+        api = self.api  # another thread may drop self.api at any time
+        if api:
+            try:
+                data = api.get(f"/{kind}s/{quote(name)}/json", **({"size": 1} if kind == "container" else {}))
+            except DockerAPIError as e:
+                logger.debug("inspect %s %s: %s", kind, name, e)
+            except (OSError, http.client.HTTPException, ValueError) as e:
+                self._disable_api(e)
+                api = None
+        if not api:
+            try:
+                found = json.loads(run_command(["docker", "inspect", "--type", kind, *(["--size"] if kind == "container" else []), name]) or "[]")
+                data = found[0] if found else None
+            except ValueError:
+                logger.debug("inspect %s %s: no such object", kind, name)
+        self._inspected[key] = data
+        return data
+
+    def inspect_many(self, targets: list[tuple[str, str]], jobs: int = 8) -> list[dict | None]:
+        """Inspect several (kind, name) pairs in parallel, plus the image of each container."""
+
+        def fetch(target: tuple[str, str]) -> dict | None:
+            data = self.inspect(*target)
+            if data and target[0] == "container":
+                self.inspect("image", data.get("Image", ""))
+            return data
+
+        if len(targets) < 2:
+            return [fetch(t) for t in targets]
+        with ThreadPoolExecutor(min(jobs, len(targets))) as pool:
+            return list(pool.map(fetch, targets))
+
+    def remove_container(self, container: Container) -> None:
+        """Force-remove *container* (API DELETE, or `docker rm -f`)."""
+        api = self.api
+        if api:
+            try:
+                api.request("DELETE", f"/containers/{quote(container.id)}", force=1)
+            except DockerAPIError as e:
+                if e.status != 404:
+                    logger.error("remove %s: %s", container.name, e)
+            except (OSError, http.client.HTTPException) as e:
+                self._disable_api(e)
+                run_command(f"docker rm -f {container.id}")
+        else:
+            run_command(f"docker rm -f {container.id}")
+        self.invalidate()
 
 
-def _lookup(fmt: str, filter_expr: str, match: str) -> str | None:
-    """Find *match* in ``_docker_list`` results."""
-    return next((i for i in _docker_list(fmt, filter_expr) if fnmatch.fnmatch(i, match)), None)
+INVENTORY = Inventory()
 
 
 def get_image(name: str) -> str | None:
-    return _lookup("{{.Repository}}", "images", name)
+    return next((i.repository for i in INVENTORY.images if fnmatch.fnmatch(i.repository, name)), None)
 
 
 def get_image_id(image_id: str) -> str | None:
-    return _lookup("{{.ID}}", "images", image_id)
+    return next((i.short_id for i in INVENTORY.images if fnmatch.fnmatch(i.short_id, image_id)), None)
 
 
 def get_containers(image: str) -> list[str]:
-    return _docker_list("{{.Names}}", f"ps -a --filter 'ancestor={image}'")
+    return INVENTORY.containers_of(image)
 
 
 def get_container(name: str) -> str | None:
-    return _lookup("{{.Names}}", "ps -a", name)
+    return next((c.name for c in INVENTORY.find_containers(name)), None)
 
 
 def get_container_id(cid: str) -> str | None:
-    return _lookup("{{.ID}}", "ps -a", cid)
+    return next((c.short_id for c in INVENTORY.containers if fnmatch.fnmatch(c.short_id, cid)), None)
+
+
+# -- inspect summaries ------------------------------------------------------
+
+
+def human_size(size: int | None) -> str:
+    if size is None:
+        return "-"
+    value = float(size)
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if value < 1024:
+            break
+        value /= 1024
+    else:
+        unit = "TiB"
+    return f"{value:.1f}{unit}" if unit != "B" else f"{size}B"
+
+
+def _command_line(config: dict) -> str:
+    return " ".join((config.get("Entrypoint") or []) + (config.get("Cmd") or []))
+
+
+def _layers(image: dict | None) -> dict:
+    if not image:
+        return {"count": None, "size": None}
+    return {"count": len((image.get("RootFS") or {}).get("Layers") or []), "size": image.get("Size")}
+
+
+def summarize_image(data: dict) -> dict:
+    config = data.get("Config") or {}
+    healthcheck = (config.get("Healthcheck") or {}).get("Test") or []
+    return {
+        "kind": "image",
+        "id": data.get("Id", "").removeprefix("sha256:")[:12],
+        "tags": data.get("RepoTags") or [],
+        "os": f"{data.get('Os', '')}/{data.get('Architecture', '')}",
+        "user": config.get("User", ""),
+        "cmd": " ".join(config.get("Cmd") or []),
+        "entrypoint": " ".join(config.get("Entrypoint") or []),
+        "workdir": config.get("WorkingDir", ""),
+        "env": config.get("Env") or [],
+        "ports": sorted(config.get("ExposedPorts") or {}),
+        "health": " ".join(healthcheck[1:]) if healthcheck[:1] != ["NONE"] else "",
+        "layers": _layers(data),
+    }
+
+
+def summarize_container(data: dict, image: dict | None) -> dict:
+    config = data.get("Config") or {}
+    state = data.get("State") or {}
+    host = data.get("HostConfig") or {}
+    ports = []
+    for port, bindings in sorted(((data.get("NetworkSettings") or {}).get("Ports") or {}).items()):
+        ports += [f"{port} -> {b.get('HostIp') or '0.0.0.0'}:{b.get('HostPort')}" for b in bindings or []] or [port]
+    return {
+        "kind": "container",
+        "id": data.get("Id", "")[:12],
+        "name": data.get("Name", "").lstrip("/"),
+        "image": config.get("Image", ""),
+        "state": state.get("Status", ""),
+        "started": state.get("StartedAt", ""),
+        "health": (state.get("Health") or {}).get("Status", ""),
+        "user": config.get("User", ""),
+        "entrypoint": _command_line(config),
+        "workdir": config.get("WorkingDir", ""),
+        "env": config.get("Env") or [],
+        "ports": ports,
+        "mounts": [f"{m.get('Source', '')}\t-> {m.get('Destination', '')}" for m in data.get("Mounts") or []],
+        "resources": {
+            "memory": host.get("Memory") or None,
+            "cpus": host.get("NanoCpus") / 1e9 if host.get("NanoCpus") else None,
+            "cpu_shares": host.get("CpuShares") or None,
+            "pids_limit": host.get("PidsLimit") if (host.get("PidsLimit") or 0) > 0 else None,
+        },
+        "layers": _layers(image),
+        "size_rw": data.get("SizeRw"),
+    }
+
+
+def format_summary(summary: dict) -> str:
+    lines = []
+    if summary["kind"] == "container":
+        res = summary["resources"]
+        limits = [
+            f"memory {human_size(res['memory'])}" if res["memory"] else "",
+            f"cpus {res['cpus']:g}" if res["cpus"] else "",
+            f"cpu-shares {res['cpu_shares']}" if res["cpu_shares"] else "",
+            f"pids {res['pids_limit']}" if res["pids_limit"] else "",
+        ]
+        state = summary["state"] + (f" since {summary['started']}" if summary["state"] == "running" else "")
+        lines += [
+            f"== container {summary['name']} ({summary['id']})",
+            f"Image:      {summary['image']}",
+            f"State:      {state}" + (f" ({summary['health']})" if summary["health"] else ""),
+            f"User:       {summary['user']}",
+            f"Entrypoint: {summary['entrypoint']}",
+            f"WorkingDir: {summary['workdir']}",
+            f"Resources:  {', '.join(filter(None, limits)) or 'unlimited'}",
+        ]
+    else:
+        lines += [
+            f"== image {', '.join(summary['tags']) or '<none>'} ({summary['id']})",
+            f"OS:         {summary['os']}",
+            f"User:       {summary['user']}",
+            f"Cmd:        {summary['cmd']}",
+            f"Entrypoint: {summary['entrypoint']}",
+            f"WorkingDir: {summary['workdir']}",
+        ]
+        if summary["health"]:
+            lines.append(f"Health:     {summary['health']}")
+    layers = summary["layers"]
+    if layers["count"] is not None:
+        rw = f", rw {human_size(summary['size_rw'])}" if summary.get("size_rw") is not None else ""
+        lines.append(f"Layers:     {layers['count']} ({human_size(layers['size'])}){rw}")
+    for title, items in ("Ports", summary["ports"]), ("Env", summary["env"]), ("Mounts", summary.get("mounts", [])):
+        if items:
+            lines.append(f"{title}:")
+            lines += [f"- {item}" for item in items]
+    return "\n".join(lines)
 
 
 class DockerMaster:
@@ -107,6 +497,7 @@ class DockerMaster:
         parser.add_argument("--cert", action="store_true", help="mount host certificates")
         parser.add_argument("--force", "-f", action="store_true", help="disable build cache")
         parser.add_argument("--memsize", "-m", help="memory size for the container (e.g. 512m, 2g)")
+        parser.add_argument("--json", action="store_true", help="inspect: print JSON instead of text")
         self.args = parser.parse_args()
 
         # if first arg isn't a known command, use it as name
@@ -135,12 +526,14 @@ class DockerMaster:
         # look up container/image metadata
         name = self.name or ""
         self.container = get_container(cname := self.args.container or name) or get_container_id(name)
-        self.image = get_image(name) or get_image_id(name) or (run_command(f"docker ps -a --filter 'name=^/{self.container}$' --format '{{{{.Image}}}}'") if self.container else "")
+        found = INVENTORY.container(self.container) if self.container else None
+        self.image = get_image(name) or get_image_id(name) or (found.image if found else "")
 
-        # display basic metadata
-        for k, v in ("Image", self.image), ("Container", self.container), ("Name", self.name):
-            print(f"{k:9}: {v}")
-        print()
+        # display basic metadata (not with --json, so the output stays parseable)
+        if not self.args.json:
+            for k, v in ("Image", self.image), ("Container", self.container), ("Name", self.name):
+                print(f"{k:9}: {v}")
+            print()
 
         getattr(self, f"{self.command}", self._default)()
 
@@ -204,7 +597,9 @@ class DockerMaster:
         """Return True if image OS is Windows (empty image -> False)."""
         if not self.image:
             return False
-        return run_command(f"docker inspect --format '{{{{.Os}}}}' {self.image}").strip().lower() == "windows"
+        image = INVENTORY.image(self.image)
+        data = INVENTORY.inspect("image", image.id if image else self.image)
+        return bool(data) and data.get("Os", "").lower() == "windows"
 
     def _parse_share(self, spec: str) -> tuple[Path, str] | None:
         """Parse ``src[,dest]`` share spec."""
@@ -228,25 +623,39 @@ class DockerMaster:
         self.image and print(run_command(f"docker history --human --format '{{{{.CreatedBy}}}}: {{.Size}}' {self.image}"))  # pyright: ignore[reportUnusedExpression]
 
     def inspect(self) -> None:
-        target = self.container or self.image
-        if not target:
+        """Summarize every named container/image (the resolved one by default), inspected in parallel."""
+        if len(self.params) > 1:
+            targets = [t for name in self.params if (t := self._inspect_target(name))]
+        else:
+            targets = [t for t in (self._inspect_target(self.container or self.image or ""),) if t]
+        if not targets:
             return
-        if self.container:
-            for f in (
-                "User:       {{.Config.User}}",
-                'Entrypoint: {{join .Config.Entrypoint " "}} {{join .Config.Cmd " "}}',
-                "WorkingDir: {{.Config.WorkingDir}}",
-            ):
-                print(run_command(f"docker inspect --format '{f}' {self.container}"))
-            print("Mounts:")
-            print(run_command('docker inspect --format \'{{range .Mounts}}{{println "-" .Source "\t-> " .Destination}}{{end}}\'' + f" {self.container}"))
+        summaries = []
+        for (kind, _), data in zip(targets, INVENTORY.inspect_many(targets)):
+            if not data:
+                continue
+            if kind == "container":
+                summaries.append(summarize_container(data, INVENTORY.inspect("image", data.get("Image", ""))))
+            else:
+                summaries.append(summarize_image(data))
+        if self.args.json:
+            print(json.dumps(summaries, indent=2))
         else:
-            for f in (
-                "User:       {{.Config.User}}",
-                'Cmd:        {{join .Config.Cmd " "}}',
-                'Entrypoint: {{join .Config.Entrypoint " "}}',
-            ):
-                print(run_command(f"docker inspect --format '{f}' {self.image}"))
+            print("\n\n".join(format_summary(s) for s in summaries))
+
+    def _inspect_target(self, name: str) -> tuple[str, str] | None:
+        """("container", id) or ("image", id) for *name*, containers first like start()."""
+        if not name:
+            return None
+        if cont := INVENTORY.container(name) or next(iter(INVENTORY.find_containers(name)), None):
+            return "container", cont.id
+        if cid := get_container_id(name):
+            return "container", cid
+        image = INVENTORY.image(name) or INVENTORY.image(get_image(name) or get_image_id(name) or "")
+        if image:
+            return "image", image.id
+        logger.error("no such container or image: %s", name)
+        return None
 
     def imports(self) -> None:
         if not self.args.docker:
@@ -273,9 +682,9 @@ class DockerMaster:
         if isinstance(names, str):
             names = [names]
         for name in names:
-            while cont := get_container(name):
-                print(f"remove container {cont}")
-                run_command(f"docker rm -f {cont}")
+            for cont in INVENTORY.find_containers(name):
+                print(f"remove container {cont.name}")
+                INVENTORY.remove_container(cont)
 
     def rmi(self) -> None:
         if self.image:
@@ -283,6 +692,7 @@ class DockerMaster:
             print(f"remove docker image {self.image} / {conts}")
             conts and run_command(f"docker rm -f {conts}", console=True)  # pyright: ignore[reportUnusedExpression]
             run_command(f"docker rmi {self.image}", console=True)
+            INVENTORY.invalidate()
 
     def status(self) -> None:
         run_command("systemctl status docker.service", console=True)
@@ -328,13 +738,13 @@ class DockerMaster:
             self._build()
             return
 
-        has_ct = run_command(f"docker ps -a --filter 'name=^/{self.args.container}$' --format '{{{{.Names}}}}'")
+        has_ct = self.args.container and INVENTORY.container(self.args.container)
         if not self.container and not has_ct:
             self._run()
             return
 
-        started = run_command(f"docker ps --filter 'name=^/{self.container}$' --format '{{{{.Image}}}}'")
-        if not started:
+        found = INVENTORY.container(self.container)
+        if not (found and found.running):
             print(f"docker start {self.container}")
             run_command(f"docker start {self.container}")
         print(f"docker attach {self.container}")
@@ -4,18 +4,32 @@
 from __future__ import annotations
 
 import argparse
+import csv
+import ctypes
+import errno
+import fcntl
 import functools
 import getpass
 import hashlib
+import json
 import logging
 import os
 import re
+import select
 import shlex
+import shutil
+import socket
 import subprocess
-from dataclasses import dataclass
+import sys
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass, field
 from pathlib import Path
-from time import sleep
-from typing import Sequence
+from time import perf_counter, sleep, time
+from typing import Any, Callable, Iterable, Iterator, Sequence
+
+import memory_info
 
 # ---------------------------------------------------------------------------
 # logging
@@ -32,6 +46,35 @@ Command = str | Sequence[str]
 IMAGE_EXTS = {".img", ".qcow2", ".vhdx"}
 DEFAULT_SSH_PORT = 5900
 VIRTIOFSD_TIMEOUT = 15
+USB_SERIAL_BASE_PORT = 60000
+PORT_REGISTRY = Path("/tmp/qemu-ports.json")
+PORT_RESERVATION_TTL = 120
+CPU_REGISTRY = Path("/tmp/qemu-cpus.json")
+VM_REGISTRY_DIR = Path("/tmp/qemu-vms")
+MEMORY_REGISTRY = Path("/tmp/qemu-memory.json")
+HUGEPAGE_SIZES = {"2M": 2048, "1G": 1048576}  # kB
+QMP_SOCKET_TEMPLATE = "/tmp/qmp-{vmprocid}.sock"
+# keyed on the full boot-device md5: vmuid (2 hex digits) collides within a fleet
+VIRTIOFS_SOCKET_TEMPLATE = "/tmp/virtiofs_{vmguid}.sock"
+TPM_CANCEL_TEMPLATE = "/tmp/foo-cancel-{vmguid}"
+CACHE_DIR = Path(os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache") / "qemu-launcher"
+PLAN_CACHE_DIR = CACHE_DIR / "plans"
+AIO_PROBE_CACHE = CACHE_DIR / "aio.json"
+QCOW2_INFO_CACHE = CACHE_DIR / "qcow2.json"
+QCOW2_CACHE_CLEAN_INTERVAL = 900
+AIO_ENGINES = ("auto", "io_uring", "native", "threads")
+AIO_BACKENDS = ("disk", "nvme", "stick")
+DISK_CACHE_MODES = ("none", "writeback", "writethrough", "directsync", "unsafe")
+DISK_BUSES = ("virtio-blk", "scsi-hd", "nvme")
+# QEMU attributes a launch plan restores; everything run() needs to exec and connect
+PLAN_FIELDS = (
+    "qemu_exe", "params", "opts", "kernel", "connect", "G_TERM", "vmboot", "vmname", "vmguid", "vmuid", "vmprocid", "bootype",
+    "macaddr", "hostip", "localip", "ssh_port", "spiceport", "serial_port", "ssh_host", "ssh_connect", "chkport", "_memsize",
+    "virtiofsd_cmd", "virtiofsd_sock", "qmp_sock", "cpu_slice", "cpu_nodes",
+    "hugepage_needs",
+)  # fmt: skip
+IN_CLOSE_WRITE, IN_CREATE, IN_MOVED_TO = 0x8, 0x100, 0x80
+LEASE_STATUS_DIR = Path("/var/lib/libvirt/dnsmasq")
 
 
 @dataclass(frozen=True)
@@ -49,6 +92,63 @@ class NvmeBackend:
         return f"{self.nvme_id}{ns_id}{self.extension}"
 
 
+@dataclass(frozen=True)
+class Qcow2Geometry:
+    virtual_size: int
+    cluster_size: int
+    refcount_bits: int = 16
+    extended_l2: bool = False
+
+    def cache_options(self) -> str:
+        """Drive options sizing the L2 and refcount caches to cover the whole image.
+
+        An L2 entry (16 bytes with extended L2, else 8) maps one cluster; a refcount
+        entry of *refcount_bits* covers one host cluster.
+        """
+        clusters = -(-self.virtual_size // self.cluster_size)
+        l2 = self._round(clusters * (16 if self.extended_l2 else 8))
+        refcount = self._round(clusters * self.refcount_bits // 8)
+        return f",l2-cache-size={l2},refcount-cache-size={refcount},cache-clean-interval={QCOW2_CACHE_CLEAN_INTERVAL}"
+
+    def _round(self, size: int) -> int:
+        return max(1, -(-size // self.cluster_size)) * self.cluster_size
+
+
+@dataclass(frozen=True)
+class ShareProfile:
+    """virtiofsd tuning for the home share (``--share-profile``)."""
+
+    cache: str | None = None  # Rust names: never, metadata, auto, always
+    thread_pool_size: int | None = None
+    announce_submounts: bool = False
+    inode_file_handles: bool = False
+    xattr: bool = False
+
+    def rust_args(self) -> list[str]:
+        args = [f"--cache={self.cache}"] if self.cache else []
+        args += [f"--thread-pool-size={self.thread_pool_size}"] if self.thread_pool_size is not None else []
+        args += ["--announce-submounts"] if self.announce_submounts else []
+        args += ["--inode-file-handles=prefer"] if self.inode_file_handles else []
+        return args + (["--xattr"] if self.xattr else [])
+
+    def legacy_args(self) -> list[str]:
+        """The C virtiofsd takes ``-o`` options, spells never as none and has no file-handle mode."""
+        opts = [f"cache={'none' if self.cache == 'never' else self.cache}"] if self.cache in ("never", "auto", "always") else []
+        opts += ["announce_submounts"] if self.announce_submounts else []
+        opts += ["xattr"] if self.xattr else []
+        args = [f"--thread-pool-size={self.thread_pool_size}"] if self.thread_pool_size is not None else []
+        return args + (["-o " + ",".join(opts)] if opts else [])
+
+
+SHARE_PROFILES = {
+    "default": ShareProfile(),
+    # guest-owned trees (kernel builds): keep dentries, attrs and data cached, serve requests in parallel
+    "build": ShareProfile(cache="always", thread_pool_size=16, announce_submounts=True, inode_file_handles=True),
+    # files edited on both sides: no guest caching, so host changes show up immediately
+    "safe": ShareProfile(cache="never", announce_submounts=True, xattr=True),
+}
+
+
 @dataclass(frozen=True)
 class NvmeOptions:
     max_ioqpairs: int
@@ -56,6 +156,830 @@ class NvmeOptions:
     namespace: str = ""
 
 
+@dataclass
+class StartupProfiler:
+    """Collect wall time per launch phase and per external command."""
+
+    phases: list[tuple[str, float]] = field(default_factory=list)
+    commands: list[tuple[str, str, float, int]] = field(default_factory=list)
+    started: float = field(default_factory=perf_counter)
+    _local: threading.local = field(default_factory=threading.local, repr=False)
+
+    @property
+    def current(self) -> str:
+        """Phase of the calling thread; probe threads report under their own name."""
+        return getattr(self._local, "name", "startup")
+
+    @current.setter
+    def current(self, name: str) -> None:
+        self._local.name = name
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        previous, self.current = self.current, name
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append((name, perf_counter() - start))
+            self.current = previous
+
+    def record(self, argv: Sequence[str], elapsed: float, returncode: int) -> None:
+        self.commands.append((self.current, shlex.join(argv), elapsed, returncode))
+
+    @property
+    def total(self) -> float:
+        return perf_counter() - self.started
+
+    def report(self) -> str:
+        total = self.total
+        lines = [f"startup profile: {total * 1000:.1f} ms total", f"{'phase':<24}{'ms':>10}{'%':>7}{'cmds':>6}"]
+        per_phase: dict[str, float] = {}
+        for name, elapsed in self.phases:
+            per_phase[name] = per_phase.get(name, 0.0) + elapsed
+        for name, elapsed in sorted(per_phase.items(), key=lambda p: p[1], reverse=True):
+            count = sum(1 for c in self.commands if c[0] == name)
+            lines.append(f"{name:<24}{elapsed * 1000:>10.1f}{elapsed / total * 100 if total else 0:>7.1f}{count:>6}")
+        if self.commands:
+            lines.append(f"{'external command':<64}{'ms':>10}  phase")
+            for phase, cmd, elapsed, rc in sorted(self.commands, key=lambda c: c[2], reverse=True):
+                text = cmd if len(cmd) <= 62 else cmd[:59] + "..."
+                lines.append(f"{text:<64}{elapsed * 1000:>10.1f}  {phase}{'' if rc == 0 else f' (rc={rc})'}")
+        return "\n".join(lines)
+
+    def dump(self, path: str | Path, **extra: object) -> None:
+        data = {
+            "timestamp": time(),
+            "total": self.total,
+            "phases": [{"name": n, "seconds": e} for n, e in self.phases],
+            "commands": [{"phase": p, "cmd": c, "seconds": e, "returncode": rc} for p, c, e, rc in self.commands],
+            **extra,
+        }
+        Path(path).write_text(json.dumps(data, indent=2))
+
+
+def used_tcp_ports() -> set[int]:
+    """Return local TCP ports known to the kernel, parsed from /proc/net/tcp{,6}."""
+    ports: set[int] = set()
+    for table in ("/proc/net/tcp", "/proc/net/tcp6"):
+        try:
+            lines = Path(table).read_text().splitlines()[1:]
+        except OSError:
+            continue
+        for line in lines:
+            fields = line.split()
+            if len(fields) > 1:
+                ports.add(int(fields[1].rsplit(":", 1)[1], 16))
+    return ports
+
+
+def port_bindable(port: int) -> bool:
+    """Probe *port* with bind(); SO_REUSEADDR matches what QEMU itself does."""
+    for family, addr in ((socket.AF_INET, "0.0.0.0"), (socket.AF_INET6, "::")):
+        try:
+            with socket.socket(family, socket.SOCK_STREAM) as sock:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                sock.bind((addr, port))
+        except OSError as e:
+            if e.errno == errno.EADDRINUSE:
+                return False
+    return True
+
+
+def pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def image_format(path: str | Path) -> str:
+    return {".qcow2": "qcow2", ".vhdx": "vhdx"}.get(Path(path).suffix.lower(), "raw")
+
+
+def file_fingerprint(path: str, volatile: bool = False) -> list[int] | None:
+    """Identify *path* for launch-plan validation; None when it does not exist.
+
+    Guest-writable disks change mtime on every boot, so for those only the
+    file identity and virtual size count: replacing or resizing the image
+    invalidates a plan, merely using it does not.
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    if not volatile:
+        return [st.st_mtime_ns, st.st_size]
+    size = st.st_size
+    if path.endswith(".qcow2"):
+        try:
+            with open(path, "rb") as f:
+                header = f.read(32)
+            if header[:4] == b"QFI\xfb":
+                size = int.from_bytes(header[24:32], "big")
+        except OSError:
+            pass
+    return [st.st_dev, st.st_ino, size]
+
+
+def open_files(paths: Iterable[str]) -> set[str]:
+    """Return the subset of *paths* held open by any visible process.
+
+    One pass over ``/proc/*/fd`` replaces an ``lsof`` per file.
+    """
+    wanted = {os.path.realpath(p): p for p in paths}
+    in_use: set[str] = set()
+    for entry in os.scandir("/proc"):
+        if not entry.name.isdigit() or entry.name == str(os.getpid()):
+            continue
+        try:
+            fds = os.listdir(f"/proc/{entry.name}/fd")
+        except OSError:
+            continue
+        for fd in fds:
+            try:
+                target = os.readlink(f"/proc/{entry.name}/fd/{fd}")
+            except OSError:
+                continue
+            if target in wanted:
+                in_use.add(wanted[target])
+    return in_use
+
+
+def wait_until(predicate: Callable[[], object], timeout: float, initial: float = 0.02, maximum: float = 0.5) -> bool:
+    """Poll *predicate* with exponential backoff until it is truthy or *timeout* expires."""
+    deadline = perf_counter() + timeout
+    delay = initial
+    while True:
+        if predicate():
+            return True
+        remaining = deadline - perf_counter()
+        if remaining <= 0:
+            return False
+        sleep(min(delay, remaining))
+        delay = min(delay * 2, maximum)
+
+
+def find_pids(comm: str) -> list[int]:
+    """Return pids whose command name matches *comm*, like ``ps -C`` without the fork."""
+    pids: list[int] = []
+    for entry in os.scandir("/proc"):
+        if not entry.name.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry.name}/comm") as f:
+                if f.read().rstrip("\n") == comm[:15]:
+                    pids.append(int(entry.name))
+        except OSError:
+            continue
+    return pids
+
+
+def process_named(pid: int, comm: str) -> bool:
+    """Whether *pid* is alive and still called *comm* (guards against pid reuse)."""
+    try:
+        with open(f"/proc/{pid}/comm") as f:
+            return f.read().rstrip("\n") == comm[:15]
+    except OSError:
+        return False
+
+
+def pid_exited(pidfd: int | None) -> bool:
+    """Non-blocking check whether the process behind *pidfd* has exited."""
+    if pidfd is None:
+        return False
+    return bool(select.select([pidfd], [], [], 0)[0])
+
+
+def inotify_until(directory: Path, mask: int, pred: Callable[[], bool], timeout: float) -> bool:
+    """Wait for *pred*, re-checking it whenever inotify reports *mask* events in *directory*.
+
+    Falls back to backoff polling when inotify is not available.
+    """
+    if pred():
+        return True
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    except (OSError, AttributeError):
+        fd = -1
+    if fd < 0:
+        return wait_until(pred, timeout)
+    try:
+        if libc.inotify_add_watch(fd, str(directory).encode(), mask) < 0:
+            return wait_until(pred, timeout)
+        deadline = perf_counter() + timeout
+        while not pred():
+            remaining = deadline - perf_counter()
+            if remaining <= 0:
+                return False
+            if select.select([fd], [], [], remaining)[0]:
+                try:
+                    os.read(fd, 4096)
+                except BlockingIOError:
+                    pass
+        return True
+    finally:
+        os.close(fd)
+
+
+def inotify_wait(path: Path, timeout: float) -> bool:
+    """Wait for *path* to appear using inotify on its parent directory."""
+    return inotify_until(path.parent, IN_CREATE | IN_MOVED_TO, path.exists, timeout)
+
+
+def qmp_greeting(path: str, timeout: float = 1.0) -> dict | None:
+    """Connect to a QMP socket and return its greeting, or None if nobody answers."""
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(timeout)
+            sock.connect(path)
+            line = sock.makefile("rb").readline()
+    except OSError:
+        return None
+    try:
+        greeting = json.loads(line)
+    except ValueError:
+        return None
+    return greeting if "QMP" in greeting else None
+
+
+def tcp_open(host: str, port: int, timeout: float = 0.5) -> bool:
+    try:
+        with socket.create_connection((host, port), timeout=timeout):
+            return True
+    except OSError:
+        return False
+
+
+class DuplicateVM(RuntimeError):
+    """Another VM of the same fleet already boots from these devices."""
+
+
+class QMPError(RuntimeError):
+    """Raised when QEMU answers a QMP command with an error."""
+
+
+class QMPClient:
+    """Minimal synchronous QMP client for a unix socket."""
+
+    def __init__(self, path: str, timeout: float = 10.0) -> None:
+        self.path = path
+        self.timeout = timeout
+        self.events: list[dict] = []
+        self.greeting: dict = {}
+        self._sock: socket.socket | None = None
+        self._file = None
+
+    def __enter__(self) -> "QMPClient":
+        self.connect()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def connect(self) -> None:
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.settimeout(self.timeout)
+        self._sock.connect(self.path)
+        self._file = self._sock.makefile("rwb")
+        self.greeting = self._read()
+        self.execute("qmp_capabilities")
+
+    def close(self) -> None:
+        if self._file:
+            self._file.close()
+        if self._sock:
+            self._sock.close()
+        self._sock = self._file = None
+
+    def _read(self) -> dict:
+        assert self._file is not None
+        line = self._file.readline()
+        if not line:
+            raise ConnectionError(f"QMP connection closed: {self.path}")
+        return json.loads(line)
+
+    def execute(self, command: str, **arguments: Any) -> Any:
+        assert self._file is not None
+        request: dict[str, Any] = {"execute": command}
+        if arguments:
+            request["arguments"] = arguments
+        self._file.write(json.dumps(request).encode() + b"\n")
+        self._file.flush()
+        while True:
+            reply = self._read()
+            if "event" in reply:
+                self.events.append(reply)
+                continue
+            if "error" in reply:
+                raise QMPError(f"{command}: {reply['error'].get('desc', reply['error'])}")
+            return reply.get("return")
+
+    def wait_event(self, name: str, timeout: float, **match: Any) -> dict | None:
+        """Return the first event *name* whose data contains *match*, waiting up to *timeout*."""
+        assert self._sock is not None
+        deadline = perf_counter() + timeout
+        while True:
+            for event in self.events:
+                if event["event"] == name and all(event.get("data", {}).get(k) == v for k, v in match.items()):
+                    self.events.remove(event)
+                    return event
+            remaining = deadline - perf_counter()
+            if remaining <= 0:
+                return None
+            self._sock.settimeout(remaining)
+            try:
+                self.events.append(self._read())
+            except socket.timeout:
+                return None
+            finally:
+                self._sock.settimeout(self.timeout)
+
+
+def open_shared(path: Path, flags: int) -> int:
+    """Open a file every local user shares, creating it world-writable (0666 regardless of umask) if missing.
+
+    Existing files are opened without O_CREAT: fs.protected_regular refuses O_CREAT on another user's file in sticky /tmp.
+    """
+    try:
+        return os.open(path, flags)
+    except FileNotFoundError:
+        pass
+    try:
+        fd = os.open(path, flags | os.O_CREAT | os.O_EXCL, 0o666)
+    except FileExistsError:
+        return os.open(path, flags)
+    os.fchmod(fd, 0o666)
+    return fd
+
+
+@contextmanager
+def locked_registry(path: Path, alive: Callable[[str, dict], bool]) -> Iterator[dict[str, dict]]:
+    """Load a flock-guarded JSON registry, drop dead entries, and save it back on exit."""
+    try:
+        fd = open_shared(path.with_suffix(".lock"), os.O_RDWR)
+    except OSError as e:
+        logger.warning("registry %s unavailable, not coordinating with other launchers: %s", path, e)
+        yield {}
+        return
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            entries = json.loads(path.read_text())
+        except (OSError, ValueError):
+            entries = {}
+        entries = {k: v for k, v in entries.items() if alive(k, v)}
+        yield entries
+        try:
+            with os.fdopen(open_shared(path, os.O_WRONLY | os.O_TRUNC), "w") as f:
+                json.dump(entries, f)
+        except OSError as e:
+            logger.warning("can't update registry %s: %s", path, e)
+    finally:
+        os.close(fd)
+
+
+class PortAllocator:
+    """Hand out host TCP ports in-process, coordinated across concurrent launchers.
+
+    Reservations live in a small JSON registry guarded by ``flock`` so two
+    launchers never pick the same ports before QEMU has bound them.  An entry
+    expires when its launcher exits or after ``ttl`` seconds, by which time
+    QEMU owns the port and ``/proc/net/tcp`` reports it anyway.
+    """
+
+    def __init__(self, registry: Path = PORT_REGISTRY, ttl: int = PORT_RESERVATION_TTL) -> None:
+        self.registry = registry
+        self.ttl = ttl
+
+    def _locked(self) -> Iterator[dict[str, dict]]:
+        now = time()
+        return locked_registry(self.registry, lambda _, v: pid_alive(v.get("pid", 0)) and now - v.get("time", 0) < self.ttl)
+
+    def reserve(self, owner: str, wants: dict[str, tuple[int, int, int]]) -> dict[str, int]:
+        """Reserve port blocks for *owner* in one locked pass.
+
+        ``wants`` maps a label to ``(start, count, step)``: the first port ``p``
+        from ``start`` upwards (in ``step`` increments) whose ``count``
+        consecutive ports are all free is returned under that label.
+        """
+        with self._locked() as entries:
+            entries.pop(owner, None)
+            taken = used_tcp_ports()
+            for entry in entries.values():
+                taken.update(entry.get("ports", []))
+            result: dict[str, int] = {}
+            for label, (start, count, step) in wants.items():
+                port = start
+                while any(p in taken or not port_bindable(p) for p in range(port, port + count)):
+                    port += step
+                    if port + count > 65536:
+                        raise RuntimeError(f"no free {label} port from {start}")
+                taken.update(range(port, port + count))
+                result[label] = port
+            entries[owner] = {"pid": os.getpid(), "time": time(), "ports": sorted(p for label, port in result.items() for p in range(port, port + wants[label][1]))}
+        return result
+
+
+@dataclass(frozen=True)
+class Lease:
+    ip: str
+    hostname: str = ""
+    expiry: int = 0  # epoch seconds, 0 = infinite
+
+
+class LeaseIndex:
+    """MAC -> lease view of libvirt's dnsmasq status file for one bridge.
+
+    The file is parsed again only when its mtime changes, so lookups cost a
+    stat; ``wait_for`` sleeps on inotify until the lease shows up.
+    """
+
+    def __init__(self, bridge: str = "virbr0", directory: Path = LEASE_STATUS_DIR) -> None:
+        self.path = directory / f"{bridge}.status"
+        self._mtime: int | None = None
+        self._leases: dict[str, Lease] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def available(self) -> bool:
+        return os.access(self.path, os.R_OK)
+
+    def refresh(self) -> None:
+        with self._lock:
+            try:
+                mtime = os.stat(self.path).st_mtime_ns
+                if mtime == self._mtime:
+                    return
+                entries = json.loads(self.path.read_text() or "[]")
+            except (OSError, ValueError):
+                return
+            self._mtime = mtime
+            self._leases = {
+                e["mac-address"].lower(): Lease(e["ip-address"], e.get("hostname", ""), int(e.get("expiry-time", 0)))
+                for e in entries
+                if "mac-address" in e and "ip-address" in e and ":" not in e["ip-address"]
+            }
+
+    def lookup(self, mac: str) -> Lease | None:
+        """The current, unexpired IPv4 lease of *mac*."""
+        self.refresh()
+        lease = self._leases.get(mac.lower())
+        return lease if lease and (not lease.expiry or lease.expiry > time()) else None
+
+    def wait_for(self, mac: str, timeout: float) -> Lease | None:
+        """Block until *mac* holds a lease or *timeout* passes."""
+        found: list[Lease] = []
+
+        def leased() -> bool:
+            lease = self.lookup(mac)
+            if lease:
+                found.append(lease)
+            return lease is not None
+
+        inotify_until(self.path.parent, IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE, leased, timeout)
+        return found[-1] if found else None
+
+
+LEASES = LeaseIndex()
+
+
+@dataclass
+class VMRecord:
+    """What a launcher knows about one VM; ``pid == 0`` marks a stopped VM that only keeps its ports."""
+
+    vmprocid: str
+    pid: int = 0
+    ssh_port: int = DEFAULT_SSH_PORT
+    spiceport: int = DEFAULT_SSH_PORT + 1
+    serial_port: int = 0
+    macaddr: str = ""
+    hostip: str = ""
+    ip: str | None = None
+    net: str = ""
+    qmp_sock: str = ""
+    virtiofsd_pid: int = 0
+    argv: list[str] = field(default_factory=list)
+    started: float = 0.0
+    memsize: str = ""
+    balloon: int = 0
+
+    @property
+    def running(self) -> bool:
+        return bool(self.pid) and process_named(self.pid, self.vmprocid)
+
+
+class VMRegistry:
+    """Launched VMs, one JSON file per VM under ``VM_REGISTRY_DIR``.
+
+    Reading a record whose QEMU is gone rewrites it without the runtime
+    fields, so the VM keeps its ports for the next boot but never shows up
+    as running.
+    """
+
+    def __init__(self, root: Path = VM_REGISTRY_DIR) -> None:
+        self.root = root
+
+    def _path(self, vmprocid: str) -> Path:
+        return self.root / f"{vmprocid}.json"
+
+    def _load(self, path: Path) -> VMRecord | None:
+        try:
+            record = VMRecord(**json.loads(path.read_text()))
+        except (OSError, ValueError, TypeError):
+            return None
+        if record.pid and not record.running:
+            record = VMRecord(record.vmprocid, ssh_port=record.ssh_port, spiceport=record.spiceport, serial_port=record.serial_port, macaddr=record.macaddr)
+            self.put(record)
+        return record
+
+    def get(self, vmprocid: str) -> VMRecord | None:
+        return self._load(self._path(vmprocid))
+
+    def records(self) -> list[VMRecord]:
+        try:
+            paths = sorted(self.root.glob("*.json"))
+        except OSError:
+            return []
+        return [r for p in paths if (r := self._load(p))]
+
+    def put(self, record: VMRecord) -> None:
+        path = self._path(record.vmprocid)
+        tmp = path.with_suffix(f".{os.getpid()}.tmp")
+        try:
+            try:
+                self.root.mkdir()
+                os.chmod(self.root, 0o1777)  # mkdir's mode is masked by umask; every user shares this directory
+            except FileExistsError:
+                pass
+            tmp.write_text(json.dumps(record.__dict__))
+            os.replace(tmp, path)
+        except OSError as e:
+            tmp.unlink(missing_ok=True)
+            logger.warning("can't update VM registry %s: %s", path, e)
+
+    def forget(self, vmprocid: str) -> None:
+        """Drop a stopped VM's record, e.g. so it gets fresh ports."""
+        record = self.get(vmprocid)
+        if record and not record.pid:
+            self._path(vmprocid).unlink(missing_ok=True)
+
+
+class MemoryAllocator:
+    """Size guest RAM with ``memory_info`` and hold the amount until QEMU is running.
+
+    Launchers that size their guests at the same moment would each see the
+    same MemAvailable; pending sizes sit in a flock-guarded registry (like
+    ``PortAllocator``) and count against the next recommendation.  Once QEMU
+    runs, its ``-m`` is accounted by ``memory_info.committed_guest_memory``
+    and the entry is released.
+    """
+
+    def __init__(self, registry: Path = MEMORY_REGISTRY, ttl: int = PORT_RESERVATION_TTL) -> None:
+        self.registry = registry
+        self.ttl = ttl
+
+    def _locked(self) -> Iterator[dict[str, dict]]:
+        now = time()
+        return locked_registry(self.registry, lambda _, v: pid_alive(v.get("pid", 0)) and now - v.get("time", 0) < self.ttl)
+
+    def reserve(self, owner: str, hugepages: int = 0, grow_pool: bool = False) -> int:
+        """Recommend a guest size in bytes for *owner* and hold it.
+
+        *hugepages* is the page size in bytes of a hugepage-backed guest; with
+        *grow_pool* the pages ``--hugepages-reserve`` will add count as available.
+        """
+        with self._locked() as entries:
+            entries.pop(owner, None)
+            pending = sum(entry["bytes"] for entry in entries.values())
+            balloons = {r.pid: r.balloon for r in VMRegistry().records() if r.pid and r.balloon}
+            recommendation = memory_info.recommend_guest_memory(pending=pending, hugepages=hugepages, grow_pool=grow_pool, balloons=balloons)
+            if recommendation["constrained"]:
+                what = "hugepage pool" if hugepages and not grow_pool else "host memory"
+                logger.warning("%s is tight (%d MiB to spare), using the %d GiB minimum", what, max(recommendation["budget"], 0) >> 20, recommendation["size"] >> 30)
+            entries[owner] = {"pid": os.getpid(), "time": time(), "bytes": recommendation["size"]}
+        return recommendation["size"]
+
+    def release(self, owner: str) -> None:
+        with self._locked() as entries:
+            entries.pop(owner, None)
+
+
+class ProbeExecutor:
+    """Run independent host probes concurrently and join on them on demand.
+
+    Probes are scheduled as soon as their inputs exist (see
+    ``QEMU.start_probes``).  ``result`` joins a probe, or runs the fallback
+    inline when the probe was never scheduled, so callers work either way.
+    """
+
+    def __init__(self, profiler: StartupProfiler, max_workers: int = 8) -> None:
+        self.profiler = profiler
+        self.pool = ThreadPoolExecutor(max_workers, thread_name_prefix="probe")
+        self.futures: dict[str, Future] = {}
+
+    def submit(self, name: str, fn: Callable, *args) -> None:
+        def task():
+            with self.profiler.phase(f"probe:{name}"):
+                return fn(*args)
+
+        self.futures[name] = self.pool.submit(task)
+
+    def result(self, name: str, fallback: Callable | None = None, *args):
+        if name in self.futures:
+            return self.futures[name].result()
+        return fallback(*args) if fallback else None
+
+    def shutdown(self) -> None:
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+
+def parse_cpulist(text: str) -> list[int]:
+    """Expand a sysfs cpulist such as ``0-3,8-11``."""
+    cpus: list[int] = []
+    for part in text.strip().split(","):
+        if not part:
+            continue
+        lo, _, hi = part.partition("-")
+        cpus.extend(range(int(lo), int(hi or lo) + 1))
+    return cpus
+
+
+def format_cpulist(cpus: Iterable[int]) -> str:
+    ranges: list[list[int]] = []
+    for cpu in sorted(set(cpus)):
+        if ranges and ranges[-1][1] == cpu - 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ",".join(f"{lo}-{hi}" if lo != hi else str(lo) for lo, hi in ranges)
+
+
+def hugepages_free(size_kb: int, node: int | None = None) -> int:
+    """Free hugepages of *size_kb* on *node* (or host wide)."""
+    base = Path(f"/sys/devices/system/node/node{node}") if node is not None else Path("/sys/kernel/mm")
+    try:
+        return int((base / f"hugepages/hugepages-{size_kb}kB/free_hugepages").read_text())
+    except (OSError, ValueError):
+        pass
+    if node is None:  # no sysfs: /proc/meminfo describes the default size only
+        try:
+            meminfo = dict(line.split(":", 1) for line in Path("/proc/meminfo").read_text().splitlines())
+            if int(meminfo["Hugepagesize"].split()[0]) == size_kb:
+                return int(meminfo["HugePages_Free"])
+        except (OSError, KeyError, ValueError):
+            pass
+    return 0
+
+
+def hugetlbfs_mount(size_kb: int) -> str | None:
+    """Mount point of a hugetlbfs instance serving *size_kb* pages, if any."""
+    try:
+        mounts = Path("/proc/mounts").read_text().splitlines()
+        default_kb = next(int(l.split()[1]) for l in Path("/proc/meminfo").read_text().splitlines() if l.startswith("Hugepagesize:"))
+    except (OSError, StopIteration, ValueError):
+        return None
+    for line in mounts:
+        fields = line.split()
+        if len(fields) < 4 or fields[2] != "hugetlbfs":
+            continue
+        opts = dict(o.partition("=")[::2] for o in fields[3].split(","))
+        page_kb = parse_size(opts["pagesize"]) // 1024 if opts.get("pagesize") else default_kb
+        if page_kb == size_kb:
+            return fields[1]
+    return None
+
+
+def parse_size(text: str) -> int:
+    """Convert a QEMU style size (``8G``, ``512M``, ``4096``) to bytes; bare numbers are MiB like ``-m``."""
+    m = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([KMGT]?)i?B?\s*", text, re.IGNORECASE)
+    if not m:
+        raise ValueError(f"invalid size: {text}")
+    unit = m.group(2).upper() or "M"
+    return int(float(m.group(1)) * 1024 ** " KMGT".index(unit))
+
+
+@dataclass(frozen=True)
+class HostCpu:
+    cpu: int
+    core: int
+    package: int
+    node: int
+
+
+def read_host_topology(sysfs: Path = Path("/sys/devices/system")) -> list[HostCpu]:
+    """Online host CPUs with their core, package and NUMA node."""
+    node_of: dict[int, int] = {}
+    for node_dir in sysfs.glob("node/node[0-9]*"):
+        try:
+            for cpu in parse_cpulist((node_dir / "cpulist").read_text()):
+                node_of[cpu] = int(node_dir.name[4:])
+        except (OSError, ValueError):
+            continue
+    try:
+        online = parse_cpulist((sysfs / "cpu/online").read_text())
+    except OSError:
+        online = list(range(os.cpu_count() or 1))
+    cpus: list[HostCpu] = []
+    for cpu in online:
+        topo = sysfs / f"cpu/cpu{cpu}/topology"
+        try:
+            core = int((topo / "core_id").read_text())
+            package = int((topo / "physical_package_id").read_text())
+        except (OSError, ValueError):
+            core, package = cpu, 0
+        cpus.append(HostCpu(cpu, core, package, node_of.get(cpu, 0)))
+    return cpus
+
+
+def pick_cpu_slice(cpus: Sequence[HostCpu], claimed: set[int], vcpus: int) -> list[tuple[int, list[list[int]]]]:
+    """Choose whole host cores for *vcpus* guest CPUs, staying on as few NUMA nodes as possible.
+
+    Returns ``[(host_node, [[sibling cpus of a core], ...]), ...]`` with the same
+    number of cores on every node, or an empty list when the host has no room.
+    The core holding CPU 0 is left for the host.
+    """
+    cores: dict[tuple[int, int, int], list[int]] = {}
+    for c in cpus:
+        cores.setdefault((c.node, c.package, c.core), []).append(c.cpu)
+    if not cores:
+        return []
+    threads = max(len(v) for v in cores.values())
+    free: dict[int, list[list[int]]] = {}
+    for (node, _, _), siblings in sorted(cores.items()):
+        if 0 in siblings or claimed.intersection(siblings) or len(siblings) != threads:
+            continue
+        free.setdefault(node, []).append(sorted(siblings))
+    need = -(-vcpus // threads)
+    fitting = [n for n, c in free.items() if len(c) >= need]
+    if fitting:
+        node = min(fitting, key=lambda n: len(free[n]))  # best fit keeps big nodes for big VMs
+        return [(node, free[node][:need])]
+    nodes = sorted(free, key=lambda n: len(free[n]), reverse=True)
+    for count in range(2, len(nodes) + 1):
+        per_node = -(-need // count)
+        if all(len(free[n]) >= per_node for n in nodes[:count]):
+            return [(n, free[n][:per_node]) for n in nodes[:count]]
+    return []
+
+
+class CpuAllocator:
+    """Track which host CPUs are pinned to which VM so concurrent VMs never overlap.
+
+    An entry lives while its launcher or its QEMU process (found by vmprocid) is alive.
+    """
+
+    def __init__(self, registry: Path = CPU_REGISTRY) -> None:
+        self.registry = registry
+
+    def _locked(self) -> Iterator[dict[str, dict]]:
+        return locked_registry(self.registry, lambda owner, v: pid_alive(v.get("pid", 0)) or bool(find_pids(owner)))
+
+    def allocate(self, owner: str, vcpus: int, topology: Sequence[HostCpu]) -> list[tuple[int, list[list[int]]]]:
+        with self._locked() as entries:
+            entries.pop(owner, None)
+            claimed = {cpu for e in entries.values() for cpu in e["cpus"]}
+            chosen = pick_cpu_slice(topology, claimed, vcpus)
+            if chosen:
+                cpus = [cpu for _, node_cores in chosen for core in node_cores for cpu in core]
+                entries[owner] = {"pid": os.getpid(), "cpus": cpus, "nodes": [n for n, _ in chosen]}
+        return chosen
+
+    def claim(self, owner: str, cpus: list[int], nodes: list[int]) -> bool:
+        """Re-claim an exact CPU set (cached launch plans); False when another VM holds any of it."""
+        with self._locked() as entries:
+            entries.pop(owner, None)
+            if any(set(cpus).intersection(e["cpus"]) for e in entries.values()):
+                return False
+            entries[owner] = {"pid": os.getpid(), "cpus": cpus, "nodes": nodes}
+        return True
+
+    def housekeeping(self, owner: str, nodes: list[int], topology: Sequence[HostCpu]) -> set[int]:
+        """Host CPUs on *nodes* that no VM uses for vCPUs, for iothreads and emulator threads."""
+        with self._locked() as entries:
+            claimed = {cpu for e in entries.values() for cpu in e["cpus"]}
+        spare = {c.cpu for c in topology if c.node in nodes and c.cpu not in claimed}
+        return spare or {c.cpu for c in topology if c.cpu not in claimed} or {c.cpu for c in topology}
+
+
+def set_affinities(plan: Sequence[tuple[int, set[int]]], sudo: list[str]) -> None:
+    """Pin each thread id to its CPU set; threads owned by root are handled by one sudo'ed shell."""
+    denied: list[str] = []
+    for tid, cpus in plan:
+        try:
+            os.sched_setaffinity(tid, cpus)
+        except PermissionError:
+            denied.append(f"taskset -p -c {format_cpulist(cpus)} {tid} >/dev/null")
+        except OSError as e:
+            logger.debug("affinity %s: %s", tid, e)
+    if denied:
+        subprocess.run([*sudo, "sh", "-c", "; ".join(denied)])
+
+
 def split_command(cmd: Command) -> list[str]:
     """Convert a command string or command fragments into subprocess argv."""
     if isinstance(cmd, str):
@@ -77,12 +1001,27 @@ def default_home_folder() -> str:
     return str(candidate) if candidate.exists() else str(Path.home())
 
 
+def aio_spec(text: str) -> tuple[str, str]:
+    """argparse type for ``--aio``: ``ENGINE`` or ``BACKEND=ENGINE``."""
+    backend, _, engine = text.rpartition("=")
+    if engine not in AIO_ENGINES or (backend and backend not in AIO_BACKENDS):
+        raise argparse.ArgumentTypeError(f"expected ENGINE or BACKEND=ENGINE with ENGINE in {AIO_ENGINES} and BACKEND in {AIO_BACKENDS}")
+    return backend, engine
+
+
 def build_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter)
     parser.add_argument("--secboot", default="", action="store_const", const=".ms", help="UEFI secure boot")
     parser.add_argument("--bios", action="store_true", help="Use BIOS instead of UEFI")
     parser.add_argument("--consol", action="store_true", help="Use current tty for VM")
     parser.add_argument("--noshare", action="store_true", help="Disable virtiofs share")
+    parser.add_argument(
+        "--share-profile",
+        default="default",
+        choices=list(SHARE_PROFILES),
+        help="virtiofsd tuning for the home share\nbuild = cache=always, 16 threads, file handles (guest-owned build trees)\nsafe = cache=never, xattr (files edited on host and guest)",
+    )
+    parser.add_argument("--share-dax", metavar="SIZE", help="DAX window for the share, e.g. 2G (QEMU builds with virtio-fs DAX only)")
     parser.add_argument("--nousb", action="store_true", help="Disable USB")
     parser.add_argument("--qemu", "-q", action="store_true", help="Use system qemu binaries")
     parser.add_argument("--rmssh", action="store_true", help="Remove VM SSH key")
@@ -109,8 +1048,13 @@ def build_parser() -> argparse.ArgumentParser:
     parser.add_argument("--pcihost", help="PCI passthrough PCI address")
     parser.add_argument("--numns", type=int, help="NVMe namespace count")
     parser.add_argument("--nssize", type=int, default=40, help="NVMe namespace size (GB)")
+    parser.add_argument("--prealloc", default="off", choices=["off", "metadata", "falloc", "full"], help="Preallocation for new NVMe backing files")
+    parser.add_argument("--cluster-size", help="qcow2 cluster size for new backing files (e.g. 64k, 2M)")
+    parser.add_argument("--extended-l2", action="store_true", help="Create new qcow2 backing files with extended L2 entries (subclusters)")
     parser.add_argument("--num_queues", type=int, default=32, help="NVMe queue count")
-    parser.add_argument("--vnum", default="", help="VM copy suffix")
+    parser.add_argument("--vnum", type=int, default=0, help="Run linked clone N: a qcow2 overlay <image>-N.qcow2 on the first disk image")
+    parser.add_argument("--clones", type=int, default=0, metavar="K", help="Create and start linked clones 1..K")
+    parser.add_argument("--reset", action="store_true", help="Discard the clone overlay (and its UEFI vars) and start again from the base image")
     parser.add_argument("--sriov", action="store_true", help="Enable SR-IOV")
     parser.add_argument("--fdp", action="store_true", help="Enable FDP extensions")
     parser.add_argument("--hvci", action="store_true", help="Enable HVCI CPU features")
@@ -119,37 +1063,34 @@ def build_parser() -> argparse.ArgumentParser:
     parser.add_argument("--ext", help="Extra parameters")
     parser.add_argument("--memsize", help="Override memory size")
     parser.add_argument("--cpus", type=int, default=0, help="vCPU count")
+    parser.add_argument("--mem-merge", default="on", choices=["on", "off"], help="Let KSM merge this guest's RAM (see 'qemu.py ksm')")
+    parser.add_argument("--balloon", action="store_true", help="Add virtio-balloon with free page reporting (see 'qemu.py balloon')")
+    parser.add_argument("--hugepages", nargs="?", const="2M", choices=list(HUGEPAGE_SIZES), help="Back guest RAM with hugepages (default 2M)")
+    parser.add_argument("--hugepages-reserve", action="store_true", help="Grow the hugepage pool through sysfs when it is short")
+    parser.add_argument(
+        "--aio",
+        nargs="+",
+        type=aio_spec,
+        default=[],
+        metavar="[BACKEND=]ENGINE",
+        help="AIO engine policy, e.g. 'auto' or 'io_uring nvme=native stick=threads'\nauto = io_uring when host kernel and QEMU support it",
+    )
+    parser.add_argument("--cache", choices=DISK_CACHE_MODES, help="Cache mode for disk images (default: writeback for qcow2, none for raw)")
+    parser.add_argument("--disk-bus", choices=DISK_BUSES, help="Attach disk images as this device instead of by format")
+    parser.add_argument("--queues", type=int, default=0, help="virtio-blk/virtio-scsi queue count (default: one per vCPU)")
+    parser.add_argument("--tune-only", action="append", metavar="IMAGE", help="Apply --cache, --disk-bus and the disk --aio policy only to this image (repeatable)")
+    parser.add_argument("--iothreads", type=int, default=0, help="iothread pool size for disks (default: one per disk, up to the vCPU count)")
+    parser.add_argument("--vq-mapping", action="store_true", help="Spread each disk's queues over the whole iothread pool (QEMU 9.0+ virtio-blk, 10.0+ virtio-scsi)")
+    parser.add_argument("--topology", action="store_true", help="Mirror a host CPU slice (sockets/cores/threads, NUMA) and pin vCPU/iothread/emulator threads")
     parser.add_argument("--serial", action="store_true", help="Enable USB serial")
     parser.add_argument("--blkdbg", action="store_true", help="Enable block debug")
     parser.add_argument("--demon", action="store_true", help="Run in daemon mode (no console, no auto-connect)")
+    parser.add_argument("--replan", action="store_true", help="Ignore the cached launch plan and rebuild it")
+    parser.add_argument("--profile-startup", action="store_true", help="Print time spent in each launch phase and external command")
+    parser.add_argument("--profile-json", metavar="FILE", help="Also dump the startup profile as JSON")
     return parser
 
 
-def get_available_memory_gb() -> int:
-    """Get available memory in GB.
-
-    Returns:
-        int: Available memory in GB, or 0 if unable to read.
-    """
-    try:
-        with open("/proc/meminfo", "r") as f:
-            for line in f:
-                if line.startswith("MemAvailable:"):
-                    # Extract the number (in kB) and convert to bytes
-                    mem_available_kb = int(line.split()[1])
-                    return mem_available_kb // (1024 * 1024)
-    except (FileNotFoundError, ValueError, IndexError):
-        pass
-
-    # Fallback to the original method if /proc/meminfo is not available
-    try:
-        page_size = os.sysconf("SC_PAGE_SIZE")
-        avail_phys_pages = os.sysconf("SC_PHYS_PAGES")
-        return (page_size * avail_phys_pages) // (1024 * 1024 * 1024)
-    except (ValueError, OSError):
-        return 0
-
-
 # ---------------------------------------------------------------------------
 # QEMU class
 # ---------------------------------------------------------------------------
@@ -175,11 +1116,37 @@ class QEMU:
         self.macaddr = ""
         self.ssh_port = DEFAULT_SSH_PORT
         self.spiceport = DEFAULT_SSH_PORT + 1
+        self.serial_port = USB_SERIAL_BASE_PORT
         self.vmprocid = ""
         self.index = 0
         self._memsize: str | None = None
         self.sudo = ["sudo"] if os.getuid() else []
         self.G_TERM: list[str] = []
+        self.profiler = StartupProfiler()
+        self.qmp_sock = ""
+        self.qemu_pid: int | None = None
+        self.qemu_pidfd: int | None = None
+        self.qemu_failed = threading.Event()
+        self.probes = ProbeExecutor(self.profiler)
+        self.virtiofsd_cmd: list[str] = []
+        self.virtiofsd_pid = 0
+        self.registry = VMRegistry()
+        self.argv: list[str] = []
+        self.virtiofsd_sock: str | None = None
+        self.vcpus = 0
+        self.cpu_slice: list[int] = []
+        self.cpu_nodes: list[int] = []
+        self.numa_layout: list[tuple[int, list[int]]] = []
+        self.shared_memory = False
+        self.hugepage_needs: dict[str, int] = {}
+        self.iothreads: list[str] = []
+        self.scsi_controllers = 0
+        self._qemu_version: tuple[int, int] | None = None
+        self._io_uring: bool | None = None
+        self._aio_warned: set[str] = set()
+        self._qcow2_lock = threading.Lock()
+        # fleet hook: called with vmguid before any host side effect; False rejects the launch
+        self.claim: Callable[[str], bool] | None = None
 
     # properties -------------------------------------------------------------
 
@@ -190,8 +1157,9 @@ class QEMU:
     @property
     def memsize(self) -> str:
         if self._memsize is None:
-            gb = get_available_memory_gb()
-            self._memsize = f"{min(max(gb, 6), 16)}G"
+            page = HUGEPAGE_SIZES[self.args.hugepages] * 1024 if self.args.hugepages else 0
+            size = MemoryAllocator().reserve(self.vmprocid, page, self.args.hugepages_reserve)
+            self._memsize = f"{size >> 30}G"
         return self._memsize
 
     # command execution -----------------------------------------------------
@@ -215,18 +1183,21 @@ class QEMU:
             cmd_list = self.sudo + cmd_list
 
         logger.debug("exec: %s", shlex.join(cmd_list))
+        start = perf_counter()
         try:
             if consol:
                 return subprocess.run(cmd_list, text=True)
             if async_:
                 proc = subprocess.Popen(cmd_list, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
-                sleep(1)
+                self.profiler.record(cmd_list, perf_counter() - start, 0)
                 return proc
             completed = subprocess.run(cmd_list, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
         except FileNotFoundError as exc:
             logger.debug("command not found: %s", cmd_list[0])
+            self.profiler.record(cmd_list, perf_counter() - start, 127)
             return subprocess.CompletedProcess(cmd_list, 127, stdout=str(exc), stderr=None)
 
+        self.profiler.record(cmd_list, perf_counter() - start, completed.returncode)
         if completed.stdout:
             logger.debug(f"Return code: {completed.returncode}, Output: {completed.stdout.rstrip()}")
         return completed
@@ -238,20 +1209,42 @@ class QEMU:
 
     # argument and image parsing -------------------------------------------
 
-    def set_args(self) -> None:
-        self.args = build_parser().parse_args()
+    def set_args(self, argv: Sequence[str] | None = None) -> None:
+        self.argv = list(sys.argv[1:] if argv is None else argv)
+        self.args = build_parser().parse_args(self.argv)
 
         # logging and derived arguments
         logger.setLevel("INFO" if self.args.debug == "cmd" else self.args.debug.upper())
         if self.args.disk:
-            self.parse_disks()
+            self.probes.submit("disks", self.parse_disks)
         if self.args.nvme:
             self.vmnvme.extend(self.args.nvme)
         if self.args.memsize:
             self._memsize = self.args.memsize
+        if self.args.vnum:
+            self.make_overlay()
         if os.environ.get("SSH_CONNECTION") or os.environ.get("SSH_CLIENT"):
             self.args.demon = True
 
+    def make_overlay(self) -> None:
+        """Replace the first disk image by its linked clone ``<image>-N.qcow2``, creating it on first use."""
+        index = next((i for i, img in enumerate(self.args.images) if Path(img).suffix.lower() in IMAGE_EXTS and Path(img).is_file()), None)
+        if index is None:
+            raise RuntimeError("--vnum needs a disk image file to clone")
+        base = Path(self.args.images[index])
+        overlay = base.with_name(f"{base.stem}-{self.args.vnum}.qcow2")
+        if self.args.reset and overlay.exists():
+            if open_files([str(overlay)]):
+                raise RuntimeError(f"{overlay} is in use; stop that clone before resetting it")
+            overlay.unlink()
+            # a clone boots from its overlay file, so its vars file never carries a bootype suffix
+            self.uefi_vars("").unlink(missing_ok=True)
+        if not overlay.exists():
+            out = self.run_command(["qemu-img", "create", "-f", "qcow2", "-F", image_format(base), "-b", str(base.resolve()), str(overlay)])
+            if out.returncode != 0:
+                raise RuntimeError(f"can't create overlay {overlay}: {out.stdout}")
+        self.args.images[index] = str(overlay)
+
     def parse_disks(self) -> None:
         """Translate --disk arguments into block device paths using lsblk."""
         out = self.run_command("lsblk -d -o NAME,MODEL,SERIAL --sort NAME -n -e7")
@@ -268,6 +1261,7 @@ class QEMU:
 
     def set_images(self) -> None:
         """Inspect provided image strings and classify them."""
+        self.probes.result("disks")
         for image in self.args.images:
             p = Path(image)
             if re.match(r"^(nvme\d+):?(\d+)?$", image):
@@ -291,6 +1285,8 @@ class QEMU:
         guid = hashlib.md5("".join(boot_devs).encode()).hexdigest()
         self.vmguid, self.vmuid = guid, guid[:2]
         self.vmprocid = f"{self.vmname[:12]}_{self.vmuid}"
+        self.macaddr = self._macaddr()
+        self.qmp_sock = QMP_SOCKET_TEMPLATE.format(vmprocid=self.vmprocid)
         self.bootype = "p" if Path(self.vmboot).is_block_device() else "n" if self.vmnvme and self.vmnvme[0] == self.vmboot else ""
         self.G_TERM = [] if self.args.demon else [f"gnome-terminal --title={self.vmprocid}", "--"]
         logger.info("vmimages %s vmcd %s vmnvme %s vmkernel %s", self.vmimages, self.vmcdimages, self.vmnvme, self.args.vmkernel)
@@ -315,7 +1311,29 @@ class QEMU:
 
     def _machine_resources(self) -> list[str]:
         cpu = self.args.cpus or int((os.cpu_count() or 2) / 2)
-        return [f"-m {self.memsize}", f"-smp {cpu},sockets=1,cores={cpu},threads=1", "-nodefaults", "-rtc base=localtime"]
+        self.vcpus = cpu
+        smp = f"-smp {cpu},sockets=1,cores={cpu},threads=1"
+        if self.args.topology:
+            smp = self._host_slice_smp(cpu) or smp
+        return [f"-m {self.memsize}", smp, "-nodefaults", "-rtc base=localtime"]
+
+    def _host_slice_smp(self, cpu: int) -> str | None:
+        """Reserve a host CPU slice and return a -smp that mirrors it (one socket per host node)."""
+        topology = read_host_topology()
+        chosen = CpuAllocator().allocate(self.vmprocid, cpu, topology)
+        if not chosen:
+            logger.warning("no free host cores for %d vCPUs, running unpinned", cpu)
+            return None
+        cores, threads = len(chosen[0][1]), len(chosen[0][1][0])
+        self.vcpus = len(chosen) * cores * threads
+        if self.vcpus != cpu:
+            logger.info("vCPU count rounded to %d to fill whole host cores", self.vcpus)
+        self.cpu_slice = [c for _, node_cores in chosen for core in node_cores for c in core]
+        self.cpu_nodes = [node for node, _ in chosen]
+        per_node = cores * threads
+        self.numa_layout = [(node, list(range(i * per_node, (i + 1) * per_node))) for i, (node, _) in enumerate(chosen)]
+        logger.info("vCPUs pinned to host cpus %s (nodes %s)", format_cpulist(self.cpu_slice), self.cpu_nodes)
+        return f"-smp {self.vcpus},sockets={len(chosen)},cores={cores},threads={threads}"
 
     def _set_x86_64_params(self) -> list[str]:
         base = [
@@ -333,10 +1351,14 @@ class QEMU:
             self.opts.append(f"-vga {self.args.vga}")
         return base
 
+    def uefi_vars(self, bootype: str) -> Path:
+        clone = f"-{self.args.vnum}" if self.args.vnum else ""
+        return Path(f"./OVMF_VARS_4M{self.args.secboot}{bootype}{clone}.fd")
+
     def configure_uefi(self) -> None:
         if self.args.bios:
             return
-        varfile = Path(f"./OVMF_VARS_4M{self.args.secboot}{self.bootype}.fd")
+        varfile = self.uefi_vars(self.bootype)
         if not varfile.exists():
             try:
                 self.run_command(["cp", f"/usr/share/OVMF/OVMF_VARS_4M{self.args.secboot}.fd", str(varfile)])
@@ -372,7 +1394,7 @@ class QEMU:
 
     def configure_usb_storage(self) -> None:
         if self.args.stick and Path(self.args.stick).exists():
-            self.params += [f"-drive file={self.args.stick},if=none,format=raw,id=stick{self.index}", f"-device usb-storage,drive=stick{self.index}"]
+            self.params += [f"-drive file={self.args.stick},if=none,format=raw{self._aio('stick', False)},id=stick{self.index}", f"-device usb-storage,drive=stick{self.index}"]
             self.index += 1
 
     def configure_usb_serial(self) -> None:
@@ -381,47 +1403,149 @@ class QEMU:
         if self.args.nousb:
             return
 
-        base_port = 60000 + int(self.vmguid[:2], 16)
         bus = "xhci1.0" if self.args.arch == "x86_64" else "usb3.0"
         self.params += [
-            f"-chardev socket,id=usbserial0,host=127.0.0.1,port={base_port},server=on,wait=off",
+            f"-chardev socket,id=usbserial0,host=127.0.0.1,port={self.serial_port},server=on,wait=off",
             f"-device usb-serial,chardev=usbserial0,id=usbserialdev0,bus={bus}",
-            f"-chardev socket,id=usbserial1,host=127.0.0.1,port={base_port},server=off",
+            f"-chardev socket,id=usbserial1,host=127.0.0.1,port={self.serial_port},server=off",
             f"-device usb-serial,chardev=usbserial1,id=usbserialdev1,bus={bus}",
         ]
 
     def configure_disks(self) -> None:
-        scsi_params = [] if self.args.arch == "riscv64" else ["-object iothread,id=iothread0", "-device virtio-scsi-pci,id=scsi0,iothread=iothread0"]
-        disk_params: list[str] = []
-        for img in self.vmimages:
-            disk_params += self._disk_params(img, self.index)
+        if not self.vmimages:
+            return
+        pool = 0 if self.args.arch == "riscv64" else self.args.iothreads or max(1, min(len(self.vmimages), self.vcpus or 1))
+        self.iothreads = [f"iothread{i}" for i in range(pool)]
+        scsi_disks = sum(1 for img in self.vmimages if self._disk_bus(img) == "scsi-hd")
+        self.scsi_controllers = max(1, min(pool, scsi_disks)) if pool else 0
+        params = [f"-object iothread,id={t}" for t in self.iothreads]
+        params += [self._scsi_controller(k) for k in range(self.scsi_controllers)]
+        for slot, img in enumerate(self.vmimages):
+            params += self._disk_params(img, self.index, slot)
             self.index += 1
-        if disk_params:
-            self.params += scsi_params + disk_params
+        self.params += params
+
+    @property
+    def queues(self) -> int:
+        return self.args.queues or self.vcpus or 1
+
+    def qemu_version(self) -> tuple[int, int]:
+        if self._qemu_version is None:
+            out = self.run_command([self.qemu_exe[0], "--version"])
+            m = re.search(r"version (\d+)\.(\d+)", out.stdout or "") if out.returncode == 0 else None
+            self._qemu_version = (int(m.group(1)), int(m.group(2))) if m else (0, 0)
+        return self._qemu_version
+
+    def io_uring_supported(self) -> bool:
+        """Whether host kernel and this QEMU build accept aio=io_uring; the QEMU probe is cached per binary."""
+        if self._io_uring is None:
+            self._io_uring = self._probe_io_uring()
+        return self._io_uring
+
+    def _probe_io_uring(self) -> bool:
+        try:
+            if Path("/proc/sys/kernel/io_uring_disabled").read_text().strip() == "2":
+                return False
+        except OSError:
+            pass
+        exe = shutil.which(self.qemu_exe[0]) or self.qemu_exe[0]
+        try:
+            key = f"{exe}:{os.stat(exe).st_mtime_ns}"
+        except OSError:
+            return False
+        try:
+            cache = json.loads(AIO_PROBE_CACHE.read_text())
+        except (OSError, ValueError):
+            cache = {}
+        if key in cache:
+            return cache[key]
+        argv = [exe, "-machine", "none", "-nodefaults", "-display", "none", "-monitor", "stdio", "-drive", "if=none,file=/dev/null,format=raw,readonly=on,aio=io_uring"]
+        start = perf_counter()
+        try:
+            rc = subprocess.run(argv, input="quit\n", capture_output=True, text=True, timeout=10).returncode
+        except (OSError, subprocess.TimeoutExpired):
+            rc = -1
+        self.profiler.record(argv, perf_counter() - start, rc)
+        cache[key] = rc == 0
+        try:
+            AIO_PROBE_CACHE.parent.mkdir(parents=True, exist_ok=True)
+            AIO_PROBE_CACHE.write_text(json.dumps(cache))
+        except OSError as e:
+            logger.debug("can't save aio probe: %s", e)
+        return cache[key]
+
+    def _aio(self, backend: str, direct: bool, tuned: bool = True) -> str:
+        """``,aio=ENGINE`` for a drive of *backend*; native needs O_DIRECT (cache=none). Untuned drives get auto."""
+        policy = dict(self.args.aio) if tuned else {}
+        engine = policy.get(backend) or policy.get("", "auto")
+        if engine == "io_uring" and not self.io_uring_supported():
+            if backend not in self._aio_warned:
+                logger.warning("aio=io_uring is not supported here, choosing automatically for %s", backend)
+                self._aio_warned.add(backend)
+            engine = "auto"
+        if engine == "auto":
+            engine = "io_uring" if self.io_uring_supported() else "native" if direct else "threads"
+        if engine == "native" and not direct:
+            engine = "threads"
+        return f",aio={engine}"
+
+    def _vq_mapping(self, min_version: tuple[int, int]) -> list[dict[str, str]] | None:
+        """iothread-vq-mapping over the whole pool, when requested and the QEMU build has it."""
+        if not self.args.vq_mapping or len(self.iothreads) < 2:
+            return None
+        if self.qemu_version() < min_version:
+            logger.warning("iothread-vq-mapping needs QEMU %d.%d+ for this device, using one iothread per device", *min_version)
+            return None
+        return [{"iothread": t} for t in self.iothreads]
+
+    def _scsi_controller(self, k: int) -> str:
+        mapping = self._vq_mapping((10, 0))
+        if mapping:
+            return "-device " + shlex.quote(json.dumps({"driver": "virtio-scsi-pci", "id": f"scsi{k}", "num_queues": self.queues, "iothread-vq-mapping": mapping}))
+        return f"-device virtio-scsi-pci,id=scsi{k},iothread={self.iothreads[k]},num_queues={self.queues}"
+
+    def _virtio_blk(self, drive_id: str, index: int, slot: int) -> str:
+        if not self.iothreads:
+            return f"-device virtio-blk-pci,drive={drive_id},id=virtio-blk-pci{index}"
+        mapping = self._vq_mapping((9, 0))
+        if mapping:
+            device = {"driver": "virtio-blk-pci", "drive": drive_id, "id": f"virtio-blk-pci{index}", "num-queues": self.queues, "iothread-vq-mapping": mapping}
+            return "-device " + shlex.quote(json.dumps(device))
+        return f"-device virtio-blk-pci,drive={drive_id},id=virtio-blk-pci{index},iothread={self.iothreads[slot % len(self.iothreads)]},num-queues={self.queues}"
+
+    def _tuned(self, img: str) -> bool:
+        """Whether the --cache/--disk-bus/--aio overrides apply to *img* (all images unless --tune-only)."""
+        return not self.args.tune_only or os.path.abspath(img) in {os.path.abspath(p) for p in self.args.tune_only}
+
+    def _disk_bus(self, img: str) -> str:
+        if self.args.disk_bus and self._tuned(img):
+            return self.args.disk_bus
+        ext = Path(img).suffix.lower()
+        if img.startswith("wiftest") or ext == ".qcow2":
+            return "virtio-blk"
+        return "nvme" if ext == ".vhdx" else "scsi-hd"
 
-    def _disk_params(self, img: str, index: int) -> list[str]:
+    def _disk_params(self, img: str, index: int, slot: int = 0) -> list[str]:
         ext = Path(img).suffix.lower()
         drive_id = f"drive-{index}"
-
         if img.startswith("wiftest"):
-            return [
-                f"-drive if=none,cache=none,file=blkdebug:blkdebug.conf:{img},format=qcow2,id={drive_id}",
-                f"-device virtio-blk-pci,drive={drive_id},id=virtio-blk-pci{index}",
-            ]
-        if ext == ".qcow2":
-            return [
-                f"-drive file={img},if=none,cache=writeback,id={drive_id}",
-                f"-device virtio-blk-pci,drive={drive_id},id=virtio-blk-pci{index}",
-            ]
-        if ext == ".vhdx":
-            return [
-                f"-drive file={img},if=none,id={drive_id}",
-                f"-device nvme,drive={drive_id},serial=nvme-{index}",
-            ]
-        return [
-            f"-drive file={img},if=none,format=raw,discard=unmap,aio=native,cache=none,id={drive_id}",
-            f"-device scsi-hd,scsi-id={index},drive={drive_id},id=scsi0-{index}",
-        ]
+            source, cache = f"file=blkdebug:blkdebug.conf:{img},format=qcow2", "none"
+        elif ext == ".qcow2":
+            source, cache = f"file={img}{self._qcow2_cache(img)}", "writeback"
+        elif ext == ".vhdx":
+            source, cache = f"file={img}", None
+        else:
+            source, cache = f"file={img},format=raw,discard=unmap", "none"
+        tuned = self._tuned(img)
+        cache = (self.args.cache if tuned else None) or cache
+        drive = f"-drive {source},if=none{f',cache={cache}' if cache else ''}{self._aio('disk', cache in ('none', 'directsync'), tuned)},id={drive_id}"
+        bus = self._disk_bus(img)
+        if bus == "virtio-blk":
+            return [drive, self._virtio_blk(drive_id, index, slot)]
+        if bus == "nvme":
+            return [drive, f"-device nvme,drive={drive_id},serial=nvme-{index}"]
+        ctrl = slot % self.scsi_controllers if self.scsi_controllers else 0
+        return [drive, f"-device scsi-hd,bus=scsi{ctrl}.0,scsi-id={index},drive={drive_id},id=scsi{ctrl}-{index}"]
 
     def configure_cdrom(self) -> None:
         iface = "none"
@@ -433,10 +1557,106 @@ class QEMU:
             self.params.append(f"-device usb-storage,drive=cdrom{self.index},bus={bus}")
             self.index += 1
 
+    def qcow2_geometries(self, paths: Sequence[str]) -> dict[str, Qcow2Geometry | None]:
+        """``qemu-img info`` for each qcow2 image, cached in ``QCOW2_INFO_CACHE``.
+
+        Entries are keyed by the volatile file fingerprint (inode and virtual size),
+        not mtime, because a guest rewrites its disk on every boot.
+        """
+        with self._qcow2_lock:
+            try:
+                cache = json.loads(QCOW2_INFO_CACHE.read_text())
+            except (OSError, ValueError):
+                cache = {}
+            keys = {path: (os.path.realpath(path), file_fingerprint(path, volatile=True)) for path in paths}
+            stale = [path for path, (key, fp) in keys.items() if not cache.get(key) or cache[key]["fp"] != fp]
+            if stale:
+                phase = self.profiler.current
+
+                def info(path: str) -> Qcow2Geometry | None:
+                    with self.profiler.phase(phase):
+                        return self._qemu_img_info(path)
+
+                with ThreadPoolExecutor(min(len(stale), 8), thread_name_prefix="qemu-img") as pool:
+                    for path, geometry in zip(stale, pool.map(info, stale)):
+                        key, fp = keys[path]
+                        cache[key] = {"fp": fp, "geometry": geometry and geometry.__dict__}
+            found = {}
+            for path, (key, _) in keys.items():
+                found[path] = Qcow2Geometry(**cache[key]["geometry"]) if cache[key]["geometry"] else None
+            if stale:
+                try:
+                    QCOW2_INFO_CACHE.parent.mkdir(parents=True, exist_ok=True)
+                    QCOW2_INFO_CACHE.write_text(json.dumps({k: v for k, v in cache.items() if os.path.exists(k)}))
+                except OSError as e:
+                    logger.debug("can't save qcow2 info: %s", e)
+        return found
+
+    def _qemu_img_info(self, path: str) -> Qcow2Geometry | None:
+        out = self.run_command(["qemu-img", "info", "-U", "--output=json", path])
+        try:
+            info = json.loads(out.stdout[out.stdout.index("{") :]) if out.returncode == 0 else {}
+        except ValueError:
+            info = {}
+        if info.get("format") != "qcow2":
+            return None
+        data = info.get("format-specific", {}).get("data", {})
+        return Qcow2Geometry(info["virtual-size"], info["cluster-size"], data.get("refcount-bits", 16), data.get("extended-l2", False))
+
+    def _qcow2_cache(self, path: str) -> str:
+        """L2/refcount cache options for a qcow2 drive, empty when its geometry is unknown."""
+        known = {**(self.probes.result("qcow2") or {}), **(self.probes.result("nvme-qcow2") or {})}
+        geometry = known[path] if path in known else self.qcow2_geometries([path])[path]
+        return geometry.cache_options() if geometry else ""
+
+    def create_image(self, filename: str, size: int, raw: bool = False) -> None:
+        fmt = "raw" if raw else "qcow2"
+        prealloc = self.args.prealloc
+        if raw and prealloc == "metadata":
+            prealloc = "off"  # raw has no metadata to preallocate
+        opts = [f"preallocation={prealloc}"]
+        if self.args.cluster_size and not raw:
+            opts.append(f"cluster_size={self.args.cluster_size}")
+        if self.args.extended_l2 and not raw:
+            opts.append("extended_l2=on")
+        self.run_command(f"qemu-img create -f {fmt} -o {','.join(opts)} {filename} {size}G")
+
+    def provision_files(self, files: Sequence[tuple[str, int, bool]]) -> set[str]:
+        """Create missing backing files in parallel and return those not in use.
+
+        ``files`` holds ``(filename, size_gb, raw)`` tuples.
+        """
+        missing = [f for f in files if not Path(f[0]).exists()]
+        phase = self.profiler.current
+
+        def create(spec: tuple[str, int, bool]) -> None:
+            with self.profiler.phase(phase):
+                self.create_image(*spec)
+
+        if missing:
+            with ThreadPoolExecutor(min(len(missing), os.cpu_count() or 4, 8), thread_name_prefix="qemu-img") as pool:
+                list(pool.map(create, missing))
+        names = [f[0] for f in files]
+        return set(names) - open_files(names)
+
     def check_file(self, filename: str, size: int, raw: bool = False) -> bool:
-        if not Path(filename).exists():
-            self.run_command(f"qemu-img create -f {'raw' if raw else 'qcow2'} {filename} {size}G")
-        return self.run_command(f"lsof -w {filename}").returncode != 0
+        return filename in self.provision_files([(filename, size, raw)])
+
+    def _nvme_backends(self) -> list[NvmeBackend]:
+        return [backend for nvme in self.vmnvme if (backend := self._parse_nvme_backend(nvme)) is not None]
+
+    def _nvme_files(self) -> list[tuple[str, int, bool]]:
+        return [
+            (backend.backend_for_namespace(ns), self.args.nssize, backend.extension == ".img") for backend in self._nvme_backends() for ns in range(1, backend.namespace_count + 1)
+        ]
+
+    def provision_nvme(self) -> set[str]:
+        return self.provision_files(self._nvme_files())
+
+    def nvme_geometries(self) -> dict[str, Qcow2Geometry | None]:
+        """qcow2 geometry of the usable NVMe namespace files, once provisioning has created them."""
+        usable = self.probes.result("nvme", self.provision_nvme)
+        return self.qcow2_geometries([f for f, _, _ in self._nvme_files() if f in usable and f.endswith(".qcow2")])
 
     def configure_nvme(self) -> None:
         if not self.vmnvme:
@@ -445,12 +1665,8 @@ class QEMU:
         nvme_opts = self._nvme_options()
         blkdbg = self._blkdebug_prefix()
         params = ["-device ioh3420,bus=pcie.0,id=root1.0,slot=1", "-device x3130-upstream,bus=root1.0,id=upstream1.0"]
-        ctrl = 0
-        for nvme in self.vmnvme:
-            backend = self._parse_nvme_backend(nvme)
-            if backend is None:
-                continue
-
+        usable = self.probes.result("nvme", self.provision_nvme)
+        for ctrl, backend in enumerate(self._nvme_backends()):
             params += [
                 f"-device xio3130-downstream,bus=upstream1.0,id=downstream1.{ctrl},chassis={ctrl},multifunction=on",
                 f"-device nvme-subsys,id=nvme-subsys-{ctrl},nqn=subsys{ctrl}",
@@ -459,16 +1675,18 @@ class QEMU:
 
             for ns in range(1, backend.namespace_count + 1):
                 filename = backend.backend_for_namespace(ns)
-                if self.check_file(filename, self.args.nssize, backend.extension == ".img"):
+                if filename in usable:
                     params += [
-                        f"-drive file={blkdbg}{filename},id=nvme{ctrl}n{ns},if=none{',format=raw' if backend.extension != '.qcow2' else ''},cache=none",
+                        f"-drive file={blkdbg}{filename},id=nvme{ctrl}n{ns},if=none{self._nvme_format(backend, filename)},cache=none{self._aio('nvme', True)}",
                         f"-device nvme-ns,drive=nvme{ctrl}n{ns},bus=nvme{ctrl},nsid={ns}{nvme_opts.namespace if ns == 1 else ''}",
                     ]
-            ctrl += 1
         if Path("./events").exists():
             params.append("--trace events=./events")
         self.params += params
 
+    def _nvme_format(self, backend: NvmeBackend, filename: str) -> str:
+        return self._qcow2_cache(filename) if backend.extension == ".qcow2" else ",format=raw"
+
     def _parse_nvme_backend(self, token: str) -> NvmeBackend | None:
         match = self.NVME_INPUT_PATTERN.match(token)
         if not match:
@@ -487,7 +1705,7 @@ class QEMU:
             logger.warning("ignore invalid nvme backend: %s", token)
             return None
 
-        nvme_id = stem_match.group("nvme")
+        nvme_id = str(path.with_name(stem_match.group("nvme")))
         namespace_id = (stem_match.group("ns_id") or "") if path.suffix else "n1"
         return NvmeBackend(nvme_id, namespace_id, extension, namespace_count, False)
 
@@ -510,29 +1728,113 @@ class QEMU:
     def _blkdebug_prefix(self) -> str:
         return "blkdebug:blkdebug.conf:" if self.args.blkdbg and Path("blkdebug.conf").exists() else ""
 
-    def configure_virtiofs(self) -> None:
+    def start_virtiofsd(self) -> str | None:
+        """Start virtiofsd for the home share and return its socket path."""
         if self.args.noshare:
-            return
+            return None
         candidates = [Path("/usr/libexec/virtiofsd"), Path(self.home_folder) / "qemu/libexec/virtiofsd"]
         virtiofsd = next((str(p) for p in candidates if p.exists()), None)
         if not virtiofsd:
-            return
-        sock = f"/tmp/virtiofs_{self.vmuid}.sock"
-        cmd = [f"{virtiofsd} --socket-path={sock}", f"--shared-dir={self.home_folder}" if virtiofsd.startswith("/usr") else f"-o source={self.home_folder}"]
+            return None
+        sock = VIRTIOFS_SOCKET_TEMPLATE.format(vmguid=self.vmguid)
+        profile = SHARE_PROFILES[self.args.share_profile]
+        if virtiofsd.startswith("/usr"):
+            cmd = [f"{virtiofsd} --socket-path={sock}", f"--shared-dir={self.home_folder}", *profile.rust_args()]
+        else:
+            cmd = [f"{virtiofsd} --socket-path={sock}", f"-o source={self.home_folder}", *profile.legacy_args()]
+        self.virtiofsd_cmd, self.virtiofsd_sock = cmd, sock
+        self.spawn_virtiofsd(cmd, sock)
+        return sock
+
+    def spawn_virtiofsd(self, cmd: list[str], sock: str) -> None:
         if self.args.debug == "cmd":
             print(command_text(cmd))
         else:
             result = self.run_command(cmd, sudo=True, async_=True)
             if isinstance(result, subprocess.CompletedProcess) and result.returncode != 0:
                 raise RuntimeError(f"virtiofsd failed: {result.stdout}")
+            self.virtiofsd_pid = result.pid if isinstance(result, subprocess.Popen) else 0
             if not self.wait_for_path(Path(sock), VIRTIOFSD_TIMEOUT):
+                if isinstance(result, subprocess.Popen) and result.poll() is not None:
+                    raise RuntimeError(f"virtiofsd failed: {result.stdout.read() if result.stdout else result.returncode}")
                 raise RuntimeError(f"virtiofsd socket was not created: {sock}")
+
+    def configure_virtiofs(self) -> None:
+        sock = self.probes.result("virtiofsd", self.start_virtiofsd)
+        if not sock:
+            return
+        self.shared_memory = True
         self.params += [
             f"-chardev socket,id=char{self.vmuid},path={sock}",
-            f"-device vhost-user-fs-pci,chardev=char{self.vmuid},tag=hostfs",
-            f"-object memory-backend-memfd,id=mem,size={self.memsize},share=on -numa node,memdev=mem",
+            f"-device vhost-user-fs-pci,chardev=char{self.vmuid},tag=hostfs{f',cache-size={self.args.share_dax}' if self.args.share_dax else ''}",
         ]
 
+    def configure_memory(self) -> None:
+        """Emit explicit RAM backends for virtiofs shared memory, mirrored host NUMA nodes or hugepages."""
+        total = parse_size(self.memsize) // (1024 * 1024)
+        huge = self._hugepage_backend(total) if self.args.hugepages else None
+        if not (self.shared_memory or self.numa_layout or huge):
+            return
+        if huge:
+            backend, sizes = huge
+        else:
+            backend, sizes = ("memory-backend-memfd" if self.shared_memory else "memory-backend-ram"), self._memory_split(total, 1)
+        share = ",share=on" if self.shared_memory else ""
+        if not self.numa_layout:
+            self.params.append(f"-object {backend},id=mem,size={self.memsize}{share} -numa node,memdev=mem")
+            return
+        for i, ((host_node, cpus), size) in enumerate(zip(self.numa_layout, sizes)):
+            self.params += [
+                f"-object {backend},id=mem{i},size={size}M{share},host-nodes={host_node},policy=bind",
+                f"-numa node,nodeid={i},cpus={cpus[0]}-{cpus[-1]},memdev=mem{i}",
+            ]
+
+    def _memory_split(self, total_mib: int, unit_mib: int) -> list[int]:
+        """Split guest RAM over the guest NUMA nodes in whole *unit_mib* pieces."""
+        count = len(self.numa_layout) or 1
+        units = total_mib // unit_mib
+        per_node = units // count
+        return [per_node * unit_mib] * (count - 1) + [(units - per_node * (count - 1)) * unit_mib]
+
+    def _hugepage_backend(self, total_mib: int) -> tuple[str, list[int]] | None:
+        """Return the hugepage backend and per-node sizes, or None to fall back to normal pages."""
+        size_kb = HUGEPAGE_SIZES[self.args.hugepages]
+        page_mib = size_kb // 1024
+        if total_mib % page_mib:
+            logger.warning("memsize %s is not a multiple of %s pages, using normal pages", self.memsize, self.args.hugepages)
+            return None
+        sizes = self._memory_split(total_mib, page_mib)
+        hosts = [node for node, _ in self.numa_layout] or [None]
+        needs = {node: size // page_mib for node, size in zip(hosts, sizes)}
+        short = {node: need - hugepages_free(size_kb, node) for node, need in needs.items() if hugepages_free(size_kb, node) < need}
+        if short and self.args.hugepages_reserve:
+            self.reserve_hugepages(size_kb, short)
+            short = {node: need - hugepages_free(size_kb, node) for node, need in needs.items() if hugepages_free(size_kb, node) < need}
+        if short:
+            missing = ", ".join(f"{'any node' if n is None else f'node{n}'}: {c}" for n, c in short.items())
+            logger.warning("not enough free %s hugepages (%s short), using normal pages", self.args.hugepages, missing)
+            return None
+        self.hugepage_needs = {str(node): pages for node, pages in needs.items()}
+        mount = hugetlbfs_mount(size_kb)
+        if mount:
+            return f"memory-backend-file,mem-path={mount},prealloc=on", sizes
+        return f"memory-backend-memfd,hugetlb=on,hugetlbsize={self.args.hugepages},prealloc=on", sizes
+
+    def reserve_hugepages(self, size_kb: int, short: dict[int | None, int]) -> None:
+        """Grow the hugepage pool through sysfs by the missing page count, per NUMA node when known."""
+        for node, missing in short.items():
+            base = Path(f"/sys/devices/system/node/node{node}") if node is not None else Path("/sys/kernel/mm")
+            nr_file = base / f"hugepages/hugepages-{size_kb}kB/nr_hugepages"
+            try:
+                target = int(nr_file.read_text()) + missing
+            except (OSError, ValueError):
+                continue
+            cmd = ["sh", "-c", f"echo {target} > {nr_file}"]
+            if self.args.debug == "cmd":
+                print(command_text(cmd))
+            else:
+                self.run_command(cmd, sudo=True)
+
     def configure_ipmi(self) -> None:
         if not self.args.ipmi:
             return
@@ -553,26 +1855,39 @@ class QEMU:
             "-device virtserialport,chardev=vdagent,name=com.redhat.spice.0",
         ]
 
+    def configure_balloon(self) -> None:
+        """virtio-balloon with free page reporting, so ``qemu.py balloon`` can lend idle guest RAM back to the host."""
+        if not self.args.balloon:
+            return
+        if self.args.hugepages or self.args.pcihost:
+            logger.warning("balloon can't reclaim hugepage-backed or VFIO-pinned guest memory")
+        self.params.append("-device virtio-balloon-pci,id=balloon0,deflate-on-oom=on,free-page-reporting=on")
+
+    def configure_mem_merge(self) -> None:
+        """Mark guest RAM mergeable for KSM (``qemu.py ksm``), or opt this VM out."""
+        self.params.append(f"-machine mem-merge={self.args.mem_merge}")
+        if self.args.mem_merge == "on" and (self.shared_memory or self.args.hugepages):
+            logger.info("KSM merges neither shared (virtiofs) nor hugepage guest RAM; %s won't be deduplicated", self.vmprocid)
+
     def configure_tpm(self) -> None:
         if self.args.tpm:
-            cancel = Path(f"/tmp/foo-cancel-{self.vmuid}")
+            cancel = Path(TPM_CANCEL_TEMPLATE.format(vmguid=self.vmguid))
             cancel.touch(exist_ok=True)
             self.params += [f"-tpmdev passthrough,id=tpm0,path=/dev/tpm0,cancel-path={cancel}", "-device tpm-tis,tpmdev=tpm0"]
 
     def RemoveSSH(self) -> None:
-        ssh_file = Path(f"/tmp/{self.vmprocid}_SSH")
-        ssh_file.unlink(missing_ok=True)
+        self.registry.forget(self.vmprocid)
         cmd = f'ssh-keygen -R "[{self.hostip}]:{self.ssh_port}"' if self.args.net == "user" else f'ssh-keygen -R "{self.localip}"'
         self.run_command(cmd)
 
     def configure_net(self, set_ports: bool = False) -> None:
         """Compute networking parameters and optionally reserve ports."""
-        fh = Path(f"/tmp/{self.vmprocid}_SSH")
-        self.ssh_port = self._read_ssh_port(fh)
+        last = self.registry.get(self.vmprocid)
+        self.ssh_port = last.ssh_port if last else DEFAULT_SSH_PORT
         self.spiceport = self.ssh_port + 1
         self.macaddr = self._macaddr()
-        self.hostip = self._host_ip()
-        self.localip = self.args.ip or self._dhcp_guest_ip()
+        self.hostip = self.probes.result("hostip", self._host_ip)
+        self.localip = self.args.ip or self.probes.result("dhcp", self._dhcp_guest_ip)
 
         if not set_ports:
             return
@@ -581,16 +1896,6 @@ class QEMU:
         net_param = self._network_param()
         if net_param:
             self.params.append(net_param)
-        try:
-            fh.write_text(str(self.ssh_port))
-        except Exception as e:
-            logger.error("can't save ssh port: %s", e)
-
-    def _read_ssh_port(self, path: Path) -> int:
-        try:
-            return int(path.read_text())
-        except Exception:
-            return DEFAULT_SSH_PORT
 
     def _macaddr(self) -> str:
         return f"52:54:00:{self.vmguid[:2]}:{self.vmguid[2:4]}:{self.vmguid[4:6]}"
@@ -601,6 +1906,13 @@ class QEMU:
         return fields[6] if out.returncode == 0 and len(fields) > 6 else "localhost"
 
     def _dhcp_guest_ip(self) -> str | None:
+        """Guest IP from the dnsmasq status file; virsh only when that file can't be read."""
+        if LEASES.available:
+            lease = LEASES.lookup(self.macaddr)
+            return lease.ip if lease else None
+        return self._virsh_guest_ip()
+
+    def _virsh_guest_ip(self) -> str | None:
         result = self.run_command(f"virsh --quiet net-dhcp-leases default --mac {self.macaddr}")
         if result.returncode != 0:
             return None
@@ -613,12 +1925,13 @@ class QEMU:
         return fields[4].split("/")[0] if len(fields) > 4 else None
 
     def _reserve_ports(self) -> None:
-        while self._port_in_use(self.spiceport) or self._port_in_use(self.ssh_port):
-            self.ssh_port += 2
-            self.spiceport = self.ssh_port + 1
-
-    def _port_in_use(self, port: int) -> bool:
-        return self.run_command(f"lsof -w -i :{port}", sudo=True).returncode == 0
+        wants = {"ssh": (self.ssh_port, 2, 2)}
+        if self.args.serial and not self.args.nousb:
+            wants["serial"] = (USB_SERIAL_BASE_PORT + int(self.vmguid[:2], 16), 1, 1)
+        ports = PortAllocator().reserve(self.vmprocid, wants)
+        self.ssh_port = ports["ssh"]
+        self.spiceport = self.ssh_port + 1
+        self.serial_port = ports.get("serial", self.serial_port)
 
     def _network_param(self) -> str:
         net_map = {
@@ -657,32 +1970,111 @@ class QEMU:
     # runtime helpers -------------------------------------------------------
 
     def findProc(self, proc: str, timeout: int = 10) -> bool:
-        while self.run_command(f"ps -C {proc}").returncode:
-            timeout -= 1
-            if timeout < 0:
-                return False
-            sleep(1)
-        return True
+        """Wait for a process named *proc*: the registry's pid if it is still alive, else a /proc scan with sub-second backoff.
+
+        A failed QEMU launch (``qemu_failed``) ends the wait for our own VM early.
+        """
+        record = self.registry.get(proc) if proc == self.vmprocid else None
+        if record and record.pid:
+            self._watch_qemu(record.pid)
+            return True
+
+        pids: list[int] = []
+
+        def found() -> bool:
+            pids[:] = find_pids(proc)
+            if proc != self.vmprocid:
+                return bool(pids)
+            if pids:
+                self._watch_qemu(pids[0])
+            return bool(pids) or self.qemu_failed.is_set()
+
+        wait_until(found, timeout)
+        return bool(pids)
+
+    def _watch_qemu(self, pid: int) -> None:
+        if self.qemu_pid == pid:
+            return
+        self.qemu_pid = pid
+        try:
+            self.qemu_pidfd = os.pidfd_open(pid)
+        except (AttributeError, OSError):
+            self.qemu_pidfd = None
+
+    def qemu_exited(self) -> bool:
+        return pid_exited(self.qemu_pidfd)
+
+    def wait_qmp(self, timeout: float = 10) -> bool:
+        """Wait until QEMU answers on its QMP socket; QEMU dying aborts the wait."""
+        if not self.wait_for_path(Path(self.qmp_sock), timeout):
+            return False
+        self.claim_qmp_socket()
+        if not os.access(self.qmp_sock, os.W_OK):
+            # root-owned socket of a sudo launched QEMU: the process is all we can see
+            return not self.qemu_exited()
+
+        def done() -> bool:
+            return self.qemu_exited() or self.qemu_failed.is_set()
+
+        return wait_until(lambda: done() or qmp_greeting(self.qmp_sock), timeout) and not done()
+
+    def pin_threads(self, timeout: float = 30) -> None:
+        """Pin vCPUs one-to-one onto the reserved host slice, iothreads and emulator threads onto spare node CPUs."""
+        if not self.cpu_slice:
+            return
+        if not self.findProc(self.vmprocid, int(timeout)) or not self.wait_qmp(timeout):
+            logger.warning("%s did not come up, vCPUs left unpinned", self.vmprocid)
+            return
+        try:
+            with QMPClient(self.qmp_sock) as qmp:
+                vcpus = {c["cpu-index"]: c["thread-id"] for c in qmp.execute("query-cpus-fast")}
+                iothreads = [t["thread-id"] for t in qmp.execute("query-iothreads")]
+        except (OSError, QMPError) as e:
+            logger.warning("can't query QEMU threads: %s", e)
+            return
+        spare = CpuAllocator().housekeeping(self.vmprocid, self.cpu_nodes, read_host_topology())
+        plan = [(tid, {self.cpu_slice[i]}) for i, tid in vcpus.items() if i < len(self.cpu_slice)]
+        busy = set(vcpus.values())
+        try:
+            tasks = [int(t) for t in os.listdir(f"/proc/{self.qemu_pid}/task")]
+        except OSError:
+            tasks = []
+        plan += [(tid, spare) for tid in iothreads + tasks if tid not in busy]
+        set_affinities(plan, self.sudo)
+        logger.info("pinned %d vCPU and %d other threads of %s", len(vcpus), len(plan) - len(vcpus), self.vmprocid)
+
+    def claim_qmp_socket(self) -> None:
+        """Hand a sudo-created QMP socket to the invoking user so ``qemu.py ctl`` works without sudo."""
+        if self.sudo and not os.access(self.qmp_sock, os.W_OK):
+            self.run_command(["chown", str(os.getuid()), self.qmp_sock], sudo=True)
 
     def checkConn(self, timeout: int = 10) -> bool:
         if not self.ssh_host:
             return False
         port = self.ssh_port if self.args.net == "user" else 22
-        while self.run_command(["nc", "-z", "-w", "1", self.ssh_host, str(port)]).returncode:
-            timeout -= 1
-            if timeout < 0:
-                return False
-            sleep(1)
-        return True
+        host = self.ssh_host
+        return wait_until(lambda: self.qemu_exited() or tcp_open(host, port), timeout, initial=0.1) and not self.qemu_exited()
+
+    def await_lease(self, timeout: float) -> None:
+        """Wait for the guest's first DHCP lease on the bridge and aim the SSH connect command at it."""
+        if self.localip or self.args.net == "user" or not LEASES.available:
+            return
+        lease = LEASES.wait_for(self.macaddr, timeout)
+        if not lease:
+            logger.warning("no DHCP lease for %s after %ds", self.macaddr, timeout)
+            return
+        self.localip = lease.ip
+        record = self.registry.get(self.vmprocid)
+        if record and record.pid:
+            record.ip = lease.ip
+            self.registry.put(record)
+        if self.args.connect == "ssh":
+            self.ssh_host = self.ssh_connect = lease.ip
+            self.connect = [*self.connect[:-1], f"ssh {self.args.uname}@{lease.ip}"]
 
     def wait_for_path(self, path: Path, timeout: int) -> bool:
-        while timeout >= 0:
-            if path.exists():
-                return True
-            logger.debug("waiting for %s", path)
-            timeout -= 1
-            sleep(1)
-        return False
+        logger.debug("waiting for %s", path)
+        return inotify_wait(path, timeout)
 
     def configure_kernel(self) -> None:
         if not self.args.vmkernel:
@@ -723,7 +2115,7 @@ class QEMU:
         self.params.append(f"-device vfio-pci,host={pcihost},multifunction=on")
 
     def set_qmp(self) -> None:
-        self.params.append("-qmp unix:/tmp/qmp-sock,server=on,wait=off")
+        self.params.append(f"-qmp unix:{self.qmp_sock},server=on,wait=off")
 
     def configure_extra(self) -> None:
         if self.args.ext:
@@ -733,67 +2125,1116 @@ class QEMU:
         prefix = [] if self.args.debug == "debug" or self.args.consol else self.G_TERM
         return [*prefix, *self.qemu_exe, *self.params, *self.opts, *self.kernel]
 
+    def spawn(self, log: Path) -> subprocess.Popen:
+        """Start QEMU detached from the terminal, output going to *log*."""
+        argv = self.sudo + split_command([*self.qemu_exe, *self.params, *self.opts, *self.kernel])
+        logger.debug("spawn: %s", shlex.join(argv))
+        with open(log, "wb") as out:
+            return subprocess.Popen(argv, stdin=subprocess.DEVNULL, stdout=out, stderr=subprocess.STDOUT, start_new_session=True)
+
     # orchestration --------------------------------------------------------
 
-    def setting(self) -> None:
-        self.set_args()
-        self.set_images()
-        if self.findProc(self.vmprocid, 0):
-            self.configure_net()
-            self.configure_connect()
-            return
-        self.set_qemu()
-        self.configure_uefi()
-        self.configure_kernel()
-        self.configure_disks()
-        self.configure_usbs()
-        self.configure_cdrom()
-        self.configure_nvme()
-        self.configure_net(True)
-        self.configure_spice()
-        self.configure_virtiofs()
-        self.configure_tpm()
-        self.configure_usb_storage()
-        self.configure_ipmi()
-        self.configure_usb_serial()
-        self.configure_extra()
-        self.set_qmp()
-        # self.set_pcipass()
+    def _step(self, step, *args):
+        with self.profiler.phase(step.__name__):
+            return step(*args)
+
+    # launch-plan cache ------------------------------------------------------
+
+    def _plan_path(self) -> Path | None:
+        """Cache file for the current arguments, or None when a plan can't be reused."""
+        if self.args.disk or self.args.pcihost:
+            return None  # lsblk lookups and PCI rebinding must run every time
+        skip = {"debug", "replan", "profile_startup", "profile_json", "rmssh"}  # rmssh is replayed on every launch
+        key = {k: v for k, v in vars(self.args).items() if k not in skip}
+        key.update(cwd=os.getcwd(), user=getpass.getuser(), home=self.home_folder)
+        digest = hashlib.sha256(json.dumps(key, sort_keys=True, default=str).encode()).hexdigest()[:32]
+        return PLAN_CACHE_DIR / f"{digest}.json"
+
+    def _plan_deps(self) -> tuple[dict[str, list[int] | None], dict[str, list[int] | None]]:
+        """Fingerprint every file the plan was built from, present or not.
+
+        Returns ``(stable, volatile)``; volatile files are the guest-writable ones.
+        """
+        volatile = set(self.args.images) | {f[0] for f in self._nvme_files()}
+        stable = {os.path.abspath(__file__), "events", "blkdebug.conf", "/usr/libexec/virtiofsd", f"{self.home_folder}/qemu/libexec/virtiofsd"}
+        stable.add(shutil.which(self.qemu_exe[0]) or self.qemu_exe[0])
+        for param in self.params + self.kernel:
+            for m in re.finditer(r"(?:file|path|mem-path)=(?:blkdebug:[^:]+:)?([^,\s]+)", param):
+                (stable if "readonly=on" in param else volatile).add(m.group(1))
+        stable.update(k for k in self.kernel if not k.startswith("-"))
+        if self.args.stick:
+            volatile.add(self.args.stick)
+        return {p: file_fingerprint(p) for p in stable - volatile}, {p: file_fingerprint(p, volatile=True) for p in volatile}
+
+    def save_plan(self) -> None:
+        if self.args.debug == "cmd" or not (path := self._plan_path()):
+            return
+        plan = {name: getattr(self, name) for name in PLAN_FIELDS}
+        plan["deps"], plan["volatile_deps"] = self._plan_deps()
+        plan["nvme_files"] = [f[0] for f in self._nvme_files()]
+        plan["nvme_in_use"] = sorted(open_files(plan["nvme_files"]))
+        plan["auto_memsize"] = not self.args.memsize
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = path.with_suffix(".tmp")
+            tmp.write_text(json.dumps(plan))
+            tmp.replace(path)
+        except OSError as e:
+            logger.debug("can't save launch plan: %s", e)
+
+    def load_plan(self) -> bool:
+        """Restore a cached launch plan; True means setting() can skip to exec."""
+        path = self._plan_path()
+        if self.args.replan or not path:
+            return False
+        try:
+            plan = json.loads(path.read_text())
+        except (OSError, ValueError):
+            return False
+        checks = [(p, fp, False) for p, fp in plan["deps"].items()] + [(p, fp, True) for p, fp in plan["volatile_deps"].items()]
+        stale = next((p for p, fp, volatile in checks if file_fingerprint(p, volatile) != fp), None)
+        if stale is not None:
+            logger.debug("launch plan stale: %s changed", stale)
+            return False
+        self.claim_vm(plan["vmguid"])
+        if find_pids(plan["vmprocid"]):
+            return False  # already running: take the reconnect path
+        if plan["auto_memsize"]:
+            self.vmprocid = plan["vmprocid"]
+            if self.memsize != plan["_memsize"]:
+                return False
+        if self.args.hugepages and any(
+            hugepages_free(HUGEPAGE_SIZES[self.args.hugepages], None if node == "None" else int(node)) < pages for node, pages in plan["hugepage_needs"].items()
+        ):
+            return False  # rebuild to reserve pages or fall back
+        if open_files(plan["nvme_files"]) != set(plan["nvme_in_use"]):
+            return False
+        if not self._plan_ips_current(plan):
+            logger.debug("launch plan network changed")
+            return False
+        wants = {"ssh": (plan["ssh_port"], 2, 2)}
+        if self.args.serial and not self.args.nousb:
+            wants["serial"] = (plan["serial_port"], 1, 1)
+        ports = PortAllocator().reserve(plan["vmprocid"], wants)
+        if ports["ssh"] != plan["ssh_port"] or ports.get("serial", plan["serial_port"]) != plan["serial_port"]:
+            logger.debug("launch plan ports are taken")
+            return False
+        if plan["cpu_slice"] and not CpuAllocator().claim(plan["vmprocid"], plan["cpu_slice"], plan["cpu_nodes"]):
+            logger.debug("launch plan cpus are taken")
+            return False
+        # only now: a rejected plan must not leave its params/opts behind for the full rebuild
+        for name in PLAN_FIELDS:
+            setattr(self, name, plan[name])
+        logger.info("using cached launch plan %s", path.name)
+        self._replay_plan()
+        return True
+
+    def claim_vm(self, vmguid: str) -> None:
+        if self.claim and not self.claim(vmguid):
+            raise DuplicateVM(f"{self.args.images} already launched (same boot devices; use vnum)")
+
+    def _plan_ips_current(self, plan: dict[str, Any]) -> bool:
+        """The host route and guest lease the plan's connect command was built from still hold."""
+        if self._host_ip() != plan["hostip"]:
+            return False
+        if self.args.ip or self.args.net == "user":
+            return True
+        self.macaddr, self.vmname = plan["macaddr"], plan["vmname"]
+        return self._dhcp_guest_ip() == plan["localip"]
+
+    def _replay_plan(self) -> None:
+        """Redo the host side effects a fresh setting() would have performed."""
+        if self.virtiofsd_cmd and self.virtiofsd_sock:
+            self.spawn_virtiofsd(self.virtiofsd_cmd, self.virtiofsd_sock)
+        if self.args.tpm:
+            Path(TPM_CANCEL_TEMPLATE.format(vmguid=self.vmguid)).touch(exist_ok=True)
+        if self.args.rmssh:
+            self.RemoveSSH()
+
+    def load_running(self) -> bool:
+        """Reattach to a registered, still running VM: everything connect needs is in its record, so no probes run."""
+        record = self.registry.get(self.vmprocid)
+        if not record or not record.pid:
+            return False
+        self._watch_qemu(record.pid)
+        self.ssh_port, self.spiceport, self.serial_port = record.ssh_port, record.spiceport, record.serial_port
+        self.macaddr, self.hostip, self.qmp_sock = record.macaddr, record.hostip, record.qmp_sock
+        self.localip = self.args.ip or record.ip
+        self._memsize = self.args.memsize or record.memsize or None
+        if self.localip is None and record.net != "user":
+            self.localip = record.ip = self._dhcp_guest_ip()
+            self.registry.put(record)
         self.configure_connect()
+        return True
+
+    def register(self, timeout: float = 60) -> None:
+        """Record the freshly started QEMU in the VM registry once its process shows up."""
+        if not self.findProc(self.vmprocid, int(timeout)):
+            return
+        record = VMRecord(
+            self.vmprocid, self.qemu_pid or 0, self.ssh_port, self.spiceport, self.serial_port if self.args.serial else 0, self.macaddr, self.hostip, self.localip,
+            self.args.net, self.qmp_sock, self.virtiofsd_pid, self.argv, time(), self.memsize,
+        )  # fmt: skip
+        self.registry.put(record)
+        if not self.args.memsize:
+            MemoryAllocator().release(self.vmprocid)
+
+    def start_probes(self, launch: bool) -> None:
+        """Schedule the host probes that only need the parsed images.
+
+        Probe graph (set_args schedules ``disks``)::
+
+            disks      (lsblk)        -> set_images
+            hostip     (ip r g)       -> configure_net
+            dhcp       (dnsmasq status) -> configure_net      needs set_images (MAC)
+            virtiofsd  (daemon+sock)  -> configure_virtiofs   needs set_images (vmguid)
+            nvme       (qemu-img, /proc/*/fd) -> configure_nvme  needs set_images
+            nvme-qcow2 (qemu-img info)        -> configure_nvme  needs nvme
+            qcow2      (qemu-img info)        -> configure_disks needs set_images
+        """
+        self.probes.submit("hostip", self._host_ip)
+        if not self.args.ip:
+            self.probes.submit("dhcp", self._dhcp_guest_ip)
+        if not launch:
+            return
+        self.probes.submit("virtiofsd", self.start_virtiofsd)
+        if self.vmnvme:
+            self.probes.submit("nvme", self.provision_nvme)
+            self.probes.submit("nvme-qcow2", self.nvme_geometries)
+        qcow2 = [img for img in self.vmimages if img.lower().endswith(".qcow2")]
+        if qcow2:
+            self.probes.submit("qcow2", self.qcow2_geometries, qcow2)
+
+    def setting(self, argv: Sequence[str] | None = None) -> None:
+        try:
+            self._setting(argv)
+        except BaseException:
+            self.stop_virtiofsd()
+            raise
+        finally:
+            self.probes.shutdown()
+
+    def stop_virtiofsd(self) -> None:
+        """Stop the virtiofsd started speculatively by the probe (or a plan replay) when setting() fails."""
+        try:
+            self.probes.result("virtiofsd")  # a daemon still starting up has no pid yet
+        except Exception as e:
+            logger.debug("virtiofsd probe: %s", e)
+        if self.virtiofsd_pid and pid_alive(self.virtiofsd_pid):
+            logger.info("stopping virtiofsd %d", self.virtiofsd_pid)
+            self.run_command(["kill", str(self.virtiofsd_pid)], sudo=True)
+
+    def _setting(self, argv: Sequence[str] | None) -> None:
+        self._step(self.set_args, argv)
+        if self._step(self.load_plan):
+            return
+        self._step(self.set_images)
+        self.claim_vm(self.vmguid)
+        if self._step(self.load_running):
+            return
+        with self.profiler.phase("findProc"):
+            running = self.findProc(self.vmprocid, 0)
+        self._step(self.start_probes, not running)
+        if running:
+            self._step(self.configure_net)
+            self._step(self.configure_connect)
+            return
+        self._step(self.set_qemu)
+        self._step(self.configure_uefi)
+        self._step(self.configure_kernel)
+        self._step(self.configure_disks)
+        self._step(self.configure_usbs)
+        self._step(self.configure_cdrom)
+        self._step(self.configure_nvme)
+        self._step(self.configure_net, True)
+        self._step(self.configure_spice)
+        self._step(self.configure_virtiofs)
+        self._step(self.configure_memory)
+        self._step(self.configure_balloon)
+        self._step(self.configure_mem_merge)
+        self._step(self.configure_tpm)
+        self._step(self.configure_usb_storage)
+        self._step(self.configure_ipmi)
+        self._step(self.configure_usb_serial)
+        self._step(self.configure_extra)
+        self._step(self.set_qmp)
+        # self._step(self.set_pcipass)
+        self._step(self.configure_connect)
+        self._step(self.save_plan)
+
+    def report_startup(self) -> None:
+        """Print and optionally dump the startup profile collected so far."""
+        if not (self.args.profile_startup or self.args.profile_json):
+            return
+        if self.args.profile_startup:
+            print(self.profiler.report())
+        if self.args.profile_json:
+            try:
+                self.profiler.dump(self.args.profile_json, vmprocid=self.vmprocid, argv=self.qemu_command() if self.params else [])
+            except OSError as e:
+                logger.error("can't write startup profile: %s", e)
 
     def run(self) -> None:
         print(f"Boot: {self.vmboot:<15}, memsize: {self.memsize}, mac: {self.macaddr}, ip: {self.localip}")
         completed: subprocess.CompletedProcess[str] | subprocess.Popen[str] = subprocess.CompletedProcess(args=[], returncode=0)
-        if not self.findProc(self.vmprocid, 0):
+        with self.profiler.phase("findProc"):
+            running = self.findProc(self.vmprocid, 0)
+        self.report_startup()
+        if not running:
             qcmd = self.qemu_command()
             if self.args.debug == "cmd":
                 print(command_text(qcmd))
             else:
+                threading.Thread(target=self.register, name="register", daemon=True).start()
+                if self.cpu_slice:
+                    threading.Thread(target=self.pin_threads, name="pin", daemon=True).start()
                 if self.args.demon and self.connect:
                     print(command_text(self.connect))
                 completed = self.run_command(qcmd, sudo=bool(self.sudo), consol=self.args.consol or self.args.demon)
+                if completed.returncode:
+                    self.qemu_failed.set()
         if self.connect:
             if self.args.debug == "cmd":
                 print(command_text(self.connect))
             elif completed.returncode == 0 and self.findProc(self.vmprocid):
+                if not self.wait_qmp():
+                    logger.debug("no QMP greeting on %s", self.qmp_sock)
                 if self.args.connect == "ssh":
+                    self.await_lease(60)
                     self.checkConn(60)
                 self.run_command(self.connect, async_=True, consol=self.args.consol)
 
 
+# ---------------------------------------------------------------------------
+# live control (qemu.py ctl)
+# ---------------------------------------------------------------------------
+
+
+def find_qmp_socket(vm: str) -> str:
+    """Resolve a vmprocid (or a unique prefix of one) to its QMP socket."""
+    exact = QMP_SOCKET_TEMPLATE.format(vmprocid=vm)
+    if Path(exact).exists():
+        return exact
+    matches = sorted(str(p) for p in Path(exact).parent.glob(Path(QMP_SOCKET_TEMPLATE.format(vmprocid=f"{vm}*")).name))
+    if len(matches) != 1:
+        raise RuntimeError(f"no unique QMP socket for '{vm}': {matches or 'none found'}")
+    return matches[0]
+
+
+def block_node(filename: str, node_name: str, readonly: bool = False) -> dict[str, Any]:
+    """blockdev-add arguments for an image file or host block device."""
+    path = Path(filename)
+    protocol = "host_device" if path.is_block_device() else "file"
+    fmt = image_format(path)
+    return {
+        "driver": fmt,
+        "node-name": node_name,
+        "read-only": readonly,
+        "file": {"driver": protocol, "filename": str(path.absolute()), "cache": {"direct": fmt == "raw"}},
+    }
+
+
+def build_ctl_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="qemu.py ctl", description="Control a running VM over QMP")
+    parser.add_argument("vm", help="vmprocid (or unique prefix) of the running VM")
+    sub = parser.add_subparsers(dest="action", required=True)
+    sub.add_parser("list", help="List block devices")
+    p = sub.add_parser("add-disk", help="Hotplug a disk image")
+    p.add_argument("file")
+    p.add_argument("--bus", default="virtio-blk", choices=["virtio-blk", "scsi-hd"], help="Attachment type")
+    p.add_argument("--id", help="Device/node id (default: derived from the file name)")
+    p = sub.add_parser("add-ns", help="Hotplug an NVMe namespace into an existing controller")
+    p.add_argument("file")
+    p.add_argument("--ctrl", type=int, default=0, help="Controller index (nvme-subsys-N)")
+    p.add_argument("--nsid", type=int, required=True, help="Namespace id")
+    p.add_argument("--bus", help="Bus to attach to (default: nvme-subsys-CTRL)")
+    p = sub.add_parser("add-stick", help="Hotplug a USB stick image")
+    p.add_argument("file")
+    p.add_argument("--id", help="Device/node id")
+    p = sub.add_parser("del", help="Unplug a device added with ctl")
+    p.add_argument("id")
+    p.add_argument("--timeout", type=float, default=10, help="Seconds to wait for the guest to release it")
+    p = sub.add_parser("qmp", help="Send a raw QMP command")
+    p.add_argument("command")
+    p.add_argument("arguments", nargs="?", default="{}", help="JSON arguments")
+    return parser
+
+
+def _hotplug(qmp: QMPClient, node: dict[str, Any], device: dict[str, Any]) -> None:
+    qmp.execute("blockdev-add", **node)
+    try:
+        qmp.execute("device_add", **device)
+    except QMPError:
+        qmp.execute("blockdev-del", **{"node-name": node["node-name"]})
+        raise
+    print(f"added {device['id']} ({device['driver']}) <- {node['file']['filename']}")
+
+
+def ctl_main(argv: Sequence[str]) -> None:
+    args = build_ctl_parser().parse_args(argv)
+    with QMPClient(find_qmp_socket(args.vm)) as qmp:
+        if args.action == "list":
+            for blk in qmp.execute("query-block"):
+                image = blk.get("inserted", {}).get("image", {})
+                print(f"{blk.get('qdev') or blk['device']:<40} {image.get('format', '-'):<6} {image.get('filename', '(empty)')}")
+        elif args.action == "add-disk":
+            dev_id = args.id or f"hp-{Path(args.file).stem}"
+            device = {"driver": "virtio-blk-pci" if args.bus == "virtio-blk" else "scsi-hd", "drive": dev_id, "id": dev_id}
+            if args.bus == "scsi-hd":
+                device["bus"] = "scsi0.0"
+            _hotplug(qmp, block_node(args.file, dev_id), device)
+        elif args.action == "add-ns":
+            dev_id = f"hp-nvme{args.ctrl}n{args.nsid}"
+            device = {"driver": "nvme-ns", "drive": dev_id, "id": dev_id, "bus": args.bus or f"nvme-subsys-{args.ctrl}", "nsid": args.nsid}
+            _hotplug(qmp, block_node(args.file, dev_id), device)
+        elif args.action == "add-stick":
+            dev_id = args.id or f"hp-{Path(args.file).stem}"
+            _hotplug(qmp, block_node(args.file, dev_id), {"driver": "usb-storage", "drive": dev_id, "id": dev_id, "removable": True})
+        elif args.action == "del":
+            qmp.execute("device_del", id=args.id)
+            if not qmp.wait_event("DEVICE_DELETED", args.timeout, device=args.id):
+                raise RuntimeError(f"guest did not release {args.id} within {args.timeout}s")
+            try:
+                qmp.execute("blockdev-del", **{"node-name": args.id})
+            except QMPError as e:
+                logger.debug("%s", e)
+            print(f"removed {args.id}")
+        elif args.action == "qmp":
+            print(json.dumps(qmp.execute(args.command, **json.loads(args.arguments)), indent=2))
+
+
+# ---------------------------------------------------------------------------
+# VM registry (qemu.py list / status)
+# ---------------------------------------------------------------------------
+
+
+def find_record(vm: str, registry: VMRegistry | None = None) -> VMRecord:
+    """Resolve a vmprocid (or a unique prefix of one) to its registry record, running VMs first."""
+    records = (registry or VMRegistry()).records()
+    exact = [r for r in records if r.vmprocid == vm]
+    matches = exact or [r for r in records if r.vmprocid.startswith(vm) and r.pid] or [r for r in records if r.vmprocid.startswith(vm)]
+    if len(matches) != 1:
+        raise RuntimeError(f"no unique VM for '{vm}': {[r.vmprocid for r in matches] or 'none registered'}")
+    return matches[0]
+
+
+def format_uptime(seconds: float) -> str:
+    minutes, _ = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours // 24}d{hours % 24:02}h" if hours >= 24 else f"{hours}h{minutes:02}m"
+
+
+def list_main(argv: Sequence[str]) -> None:
+    parser = argparse.ArgumentParser(prog="qemu.py list", description="List VMs started by this launcher")
+    parser.add_argument("--all", action="store_true", help="Include stopped VMs that still hold port preferences")
+    parser.add_argument("--json", action="store_true", help="Print records as JSON")
+    args = parser.parse_args(argv)
+
+    records = [r for r in VMRegistry().records() if args.all or r.pid]
+    if args.json:
+        print(json.dumps([r.__dict__ for r in records], indent=2))
+        return
+    now = time()
+    print(f"{'vmprocid':<18}{'pid':>8}{'ssh':>7}{'spice':>7}  {'mac':<19}{'ip':<16}{'up':>7}")
+    for r in records:
+        up = format_uptime(now - r.started) if r.pid else "-"
+        print(f"{r.vmprocid:<18}{r.pid or '-':>8}{r.ssh_port:>7}{r.spiceport:>7}  {r.macaddr:<19}{r.ip or '-':<16}{up:>7}")
+
+
+def status_main(argv: Sequence[str]) -> None:
+    parser = argparse.ArgumentParser(prog="qemu.py status", description="Show one VM's registry record and live state")
+    parser.add_argument("vm", help="vmprocid or a unique prefix of one")
+    args = parser.parse_args(argv)
+
+    record = find_record(args.vm)
+    state = "stopped"
+    if record.pid:
+        state = "running"
+        if os.access(record.qmp_sock, os.W_OK):
+            try:
+                with QMPClient(record.qmp_sock, timeout=2) as qmp:
+                    state = qmp.execute("query-status")["status"]
+            except (OSError, QMPError) as e:
+                state = f"running (QMP: {e})"
+    print(f"{'vmprocid':<12}{record.vmprocid}")
+    print(f"{'state':<12}{state}")
+    if record.pid:
+        print(f"{'pid':<12}{record.pid}, up {format_uptime(time() - record.started)}")
+        print(f"{'virtiofsd':<12}{record.virtiofsd_pid if record.virtiofsd_pid and pid_alive(record.virtiofsd_pid) else '-'}")
+        print(f"{'qmp':<12}{record.qmp_sock}")
+    print(f"{'ports':<12}ssh {record.ssh_port}, spice {record.spiceport}" + (f", serial {record.serial_port}" if record.serial_port else ""))
+    print(f"{'network':<12}{record.net or '-'} {record.macaddr} {record.ip or ''}".rstrip())
+    if record.argv:
+        print(f"{'argv':<12}{shlex.join(record.argv)}")
+
+
+# ---------------------------------------------------------------------------
+# memory balloon manager (qemu.py balloon)
+# ---------------------------------------------------------------------------
+
+BALLOON_QOM_PATH = "/machine/peripheral/balloon0"
+
+
+@dataclass
+class BalloonGuest:
+    vmprocid: str
+    qmp_sock: str
+    full: int  # configured guest RAM
+    actual: int = 0  # current balloon size (guest-visible RAM)
+    available: int = 0  # guest MemAvailable from the balloon stats, 0 until reported
+
+
+class BalloonManager:
+    """Move idle guest RAM back to the host while it is short, and return it when it is not.
+
+    Host state comes from ``memory_info``; guest state from the balloon
+    driver's statistics, which QEMU polls every *stats_interval* seconds once
+    ``guest-stats-polling-interval`` is set.  Free page reporting hands pages
+    freed inside the guest back to the host on its own; the manager only moves
+    balloon targets.
+    """
+
+    def __init__(self, low: float, high: float, floor: int, step: float, stats_interval: int, dry_run: bool = False) -> None:
+        self.low, self.high, self.floor, self.step = low, high, floor, step
+        self.stats_interval = stats_interval
+        self.dry_run = dry_run
+        self.registry = VMRegistry()
+        self._polling: set[str] = set()
+
+    def guests(self) -> list[BalloonGuest]:
+        """Running registered VMs that have a balloon, with fresh balloon stats."""
+        guests = []
+        for record in self.registry.records():
+            if not record.pid or not os.access(record.qmp_sock, os.W_OK):
+                continue
+            try:
+                with QMPClient(record.qmp_sock, timeout=2) as qmp:
+                    actual = qmp.execute("query-balloon")["actual"]
+                    if record.vmprocid not in self._polling:
+                        qmp.execute("qom-set", path=BALLOON_QOM_PATH, property="guest-stats-polling-interval", value=self.stats_interval)
+                        self._polling.add(record.vmprocid)
+                    stats = qmp.execute("qom-get", path=BALLOON_QOM_PATH, property="guest-stats").get("stats", {})
+                    full = memory_info.parse_guest_size(record.memsize) if record.memsize else qmp.execute("query-memory-size-summary")["base-memory"]
+            except (OSError, QMPError) as e:
+                logger.debug("%s: no balloon (%s)", record.vmprocid, e)
+                continue
+            available = max(stats.get("stat-available-memory", -1), 0)
+            guests.append(BalloonGuest(record.vmprocid, record.qmp_sock, full or actual, actual, available))
+        return guests
+
+    def host_short(self, meminfo: dict[str, int]) -> int:
+        """Bytes the host needs back to reach the *low* watermark; negative means spare above *high*."""
+        total = meminfo.get("MemTotal", 0)
+        available = meminfo.get("MemAvailable", 0)
+        pressure = memory_info.read_pressure().get("some", {}).get("avg10", 0)
+        if pressure > memory_info.PRESSURE_SOME_LIMIT:
+            # reclaiming hard even above the low watermark: aim for the high one
+            return max(int(total * self.high) - available, 0)
+        if available < total * self.low:
+            return int(total * self.low) - available
+        if available > total * self.high:
+            return int(total * self.high) - available
+        return 0
+
+    def plan(self, guests: list[BalloonGuest], short: int) -> dict[str, int]:
+        """New balloon targets: inflate the idlest guests while the host is short, deflate when it has spare."""
+        targets: dict[str, int] = {}
+        if short > 0:
+            for g in sorted(guests, key=lambda g: g.available, reverse=True):
+                if short <= 0 or not g.available:
+                    break
+                # at most half of what the guest itself considers available and one step, never below the floor
+                take = min(g.available // 2, g.actual - self.floor, short, int(g.full * self.step))
+                if take >= 1 << 27:
+                    targets[g.vmprocid] = g.actual - take
+                    short -= take
+        elif short < 0:
+            spare = -short
+            for g in sorted(guests, key=lambda g: g.available):
+                give = min(g.full - g.actual, spare, max(int(g.full * self.step), 1 << 27))
+                if give > 0:
+                    targets[g.vmprocid] = g.actual + give
+                    spare -= give
+        return targets
+
+    def apply(self, guests: list[BalloonGuest], targets: dict[str, int]) -> None:
+        by_id = {g.vmprocid: g for g in guests}
+        for vmprocid, target in targets.items():
+            guest = by_id[vmprocid]
+            print(f"{vmprocid:<18}{guest.actual >> 20:>8} MiB -> {target >> 20:>8} MiB  (guest available {guest.available >> 20} MiB)")
+            if self.dry_run:
+                continue
+            try:
+                with QMPClient(guest.qmp_sock, timeout=2) as qmp:
+                    qmp.execute("balloon", value=target)
+            except (OSError, QMPError) as e:
+                logger.warning("%s: balloon failed: %s", vmprocid, e)
+                continue
+            # launchers size new guests against the target, not the full -m (MemoryAllocator.reserve)
+            record = self.registry.get(vmprocid)
+            if record and record.pid:
+                record.balloon = target
+                self.registry.put(record)
+
+    def tick(self) -> None:
+        guests = self.guests()
+        if not guests:
+            return
+        self.apply(guests, self.plan(guests, self.host_short(memory_info.read_meminfo())))
+
+
+def balloon_main(argv: Sequence[str]) -> None:
+    parser = argparse.ArgumentParser(prog="qemu.py balloon", description="Balance RAM between the host and --balloon guests")
+    parser.add_argument("--interval", type=float, default=5, help="Seconds between adjustments")
+    parser.add_argument("--stats-interval", type=int, default=2, help="Guest balloon statistics polling period (seconds)")
+    parser.add_argument("--low", type=float, default=10, help="Reclaim from guests while host MemAvailable is below this %% of RAM")
+    parser.add_argument("--high", type=float, default=25, help="Give memory back while host MemAvailable is above this %% of RAM")
+    parser.add_argument("--floor", default="1G", help="Never shrink a guest below this size")
+    parser.add_argument("--step", type=float, default=10, help="Largest change per guest and tick, %% of its RAM")
+    parser.add_argument("--once", action="store_true", help="Adjust once and exit")
+    parser.add_argument("--dry-run", action="store_true", help="Print the new targets without applying them")
+    args = parser.parse_args(argv)
+
+    manager = BalloonManager(args.low / 100, args.high / 100, parse_size(args.floor), args.step / 100, args.stats_interval, args.dry_run)
+    if args.once and manager.guests():
+        sleep(args.stats_interval + 0.5)  # let the first guest statistics arrive
+    while True:
+        manager.tick()
+        if args.once:
+            return
+        sleep(args.interval)
+
+
+# ---------------------------------------------------------------------------
+# kernel samepage merging (qemu.py ksm)
+# ---------------------------------------------------------------------------
+
+KSM_SYSFS = Path("/sys/kernel/mm/ksm")
+
+
+def ksm_read() -> dict[str, int]:
+    """Every numeric KSM sysfs counter and knob."""
+    values: dict[str, int] = {}
+    try:
+        entries = list(os.scandir(KSM_SYSFS))
+    except OSError:
+        return values
+    for entry in entries:
+        try:
+            values[entry.name] = int(Path(entry.path).read_text())
+        except (OSError, ValueError):
+            continue
+    return values
+
+
+def ksm_write(settings: dict[str, int]) -> None:
+    """Write KSM knobs, through one sudo'ed shell when we are not root."""
+    denied = []
+    for name, value in settings.items():
+        try:
+            (KSM_SYSFS / name).write_text(str(value))
+        except PermissionError:
+            denied.append(f"echo {value} > {KSM_SYSFS / name}")
+        except OSError as e:
+            logger.warning("ksm %s: %s", name, e)
+    if denied:
+        subprocess.run(["sudo", "sh", "-c", "; ".join(denied)], check=True)
+
+
+def ksm_tuning(vms: int) -> dict[str, int]:
+    """Scan rate for *vms* running guests: faster and more often as the fleet grows.
+
+    Roughly 100 pages (400 KiB) per guest per pass, so a lone VM costs next
+    to nothing and a 40 VM fleet still converges in minutes.
+    """
+    pages = min(max(vms, 1) * 100, 5000)
+    sleep_ms = 200 if vms <= 2 else 50 if vms <= 8 else 20
+    return {"pages_to_scan": pages, "sleep_millisecs": sleep_ms}
+
+
+def ksmd_cpu_seconds() -> float:
+    """CPU time ksmd has used since boot."""
+    total = 0.0
+    for pid in find_pids("ksmd"):
+        try:
+            fields = Path(f"/proc/{pid}/stat").read_text().rpartition(")")[2].split()
+        except OSError:
+            continue
+        total += (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    return total
+
+
+def ksm_process_stats(pid: int) -> dict[str, int]:
+    """``/proc/PID/ksm_stat`` (ksm_merging_pages, ksm_process_profit, ...), empty on kernels without it."""
+    try:
+        lines = Path(f"/proc/{pid}/ksm_stat").read_text().splitlines()
+    except OSError:
+        return {}
+    return {k: int(v) for k, _, v in (line.partition(" ") for line in lines) if v.strip().lstrip("-").isdigit()}
+
+
+def ksm_report(interval: float) -> None:
+    page = os.sysconf("SC_PAGE_SIZE")
+    cpu0, t0, scans0 = ksmd_cpu_seconds(), perf_counter(), ksm_read().get("full_scans", 0)
+    sleep(interval)
+    ksm = ksm_read()
+    cpu1, t1 = ksmd_cpu_seconds(), perf_counter()
+    if not ksm:
+        raise RuntimeError(f"KSM is not available ({KSM_SYSFS} missing)")
+    state = {0: "stopped", 1: "running", 2: "unmerging"}.get(ksm.get("run", 0), "?")
+    saved = ksm.get("pages_sharing", 0) * page
+    print(f"ksm {state}: pages_to_scan={ksm.get('pages_to_scan')} sleep_millisecs={ksm.get('sleep_millisecs')} full_scans={ksm.get('full_scans', 0)}")
+    print(
+        f"pages_shared {ksm.get('pages_shared', 0)}  pages_sharing {ksm.get('pages_sharing', 0)}  pages_unshared {ksm.get('pages_unshared', 0)}  pages_volatile {ksm.get('pages_volatile', 0)}"
+    )
+    print(f"memory saved ~{saved / 2**30:.2f} GiB" + (f" (net of rmap overhead: {ksm['general_profit'] / 2**30:.2f} GiB)" if "general_profit" in ksm else ""))
+    busy = (cpu1 - cpu0) / (t1 - t0) * 100 if t1 > t0 else 0
+    print(f"ksmd cpu {busy:.1f}% over the last {interval:g}s, {cpu1:.0f}s since boot, {ksm.get('full_scans', 0) - scans0} full scans meanwhile")
+    if saved and cpu1:
+        print(f"  -> {saved / 2**20 / cpu1:.0f} MiB kept merged per ksmd CPU second")
+    names = {r.pid: r.vmprocid for r in VMRegistry().records() if r.pid}
+    pids = sorted(set(names) | set(memory_info.committed_guest_memory()))
+    if not pids:
+        return
+    print(f"\n{'vm':<18}{'pid':>8}{'merging MiB':>13}{'profit MiB':>12}")
+    for pid in pids:
+        stats = ksm_process_stats(pid)
+        merging = stats.get("ksm_merging_pages", 0) * page
+        profit = stats.get("ksm_process_profit")
+        print(f"{names.get(pid, '?'):<18}{pid:>8}{merging >> 20:>13}{profit >> 20 if profit is not None else '-':>12}")
+
+
+def ksm_main(argv: Sequence[str]) -> None:
+    parser = argparse.ArgumentParser(prog="qemu.py ksm", description="Manage kernel samepage merging for the running VMs")
+    sub = parser.add_subparsers(dest="action", required=True)
+    sub.add_parser("on", help="Start ksmd tuned for the running VM count")
+    sub.add_parser("tune", help="Retune scanning for the running VM count (no-op while KSM is off)")
+    p = sub.add_parser("off", help="Stop ksmd")
+    p.add_argument("--unmerge", action="store_true", help="Also break up every merged page")
+    p = sub.add_parser("report", help="Show merged pages, savings per VM and ksmd CPU cost")
+    p.add_argument("--interval", type=float, default=1.0, help="Seconds to measure ksmd CPU usage over")
+    args = parser.parse_args(argv)
+
+    if args.action == "report":
+        ksm_report(args.interval)
+        return
+    if args.action == "off":
+        ksm_write({"run": 2 if args.unmerge else 0})
+        return
+    vms = len(memory_info.committed_guest_memory())
+    settings = ksm_tuning(vms)
+    if args.action == "on":
+        settings["run"] = 1
+    elif ksm_read().get("run") != 1:
+        return
+    ksm_write(settings)
+    print(f"ksm tuned for {vms} VM(s): " + " ".join(f"{k}={v}" for k, v in settings.items()))
+
+
+# ---------------------------------------------------------------------------
+# fleet launcher (qemu.py fleet)
+# ---------------------------------------------------------------------------
+
+
+def load_manifest(path: str) -> list[dict[str, Any]]:
+    """Read a fleet manifest: a list of VM specs, or ``{"defaults": {...}, "vms": [...]}``.
+
+    JSON always works; YAML needs PyYAML.
+    """
+    text = Path(path).read_text()
+    if Path(path).suffix.lower() in (".yaml", ".yml"):
+        try:
+            import yaml  # pyright: ignore[reportMissingModuleSource]
+        except ImportError as e:
+            raise RuntimeError("PyYAML is required for YAML manifests (pip install pyyaml) or use JSON") from e
+        data = yaml.safe_load(text)
+    else:
+        data = json.loads(text)
+    if isinstance(data, list):
+        data = {"vms": data}
+    defaults = data.get("defaults") or {}
+    return [{**defaults, **vm} for vm in data.get("vms") or []]
+
+
+def spec_to_argv(spec: dict[str, Any], parser: argparse.ArgumentParser | None = None) -> list[str]:
+    """Turn a manifest entry into launcher argv using the options ``build_parser()`` exposes.
+
+    An ``argv`` entry is passed through verbatim ahead of the translated options.
+    """
+    parser = parser or build_parser()
+    actions = {a.dest: a for a in parser._actions if a.option_strings}
+    argv: list[str] = []
+    for key, value in spec.items():
+        if key in ("images", "name", "argv"):
+            continue
+        action = actions.get(key.replace("-", "_"))
+        if action is None:
+            raise ValueError(f"unknown option in manifest: {key}")
+        flag = action.option_strings[-1] if action.option_strings[-1].startswith("--") else action.option_strings[0]
+        if action.nargs == 0:
+            if value:
+                argv.append(flag)
+        elif isinstance(value, (list, tuple)):
+            argv += [flag, *map(str, value)]
+        else:
+            argv += [flag, str(value)]
+    images = spec.get("images") or []
+    return [*spec.get("argv", []), *argv, *([images] if isinstance(images, str) else images)]
+
+
+@dataclass
+class FleetResult:
+    name: str
+    vmprocid: str = ""
+    status: str = "pending"
+    ssh_port: int = 0
+    ip: str | None = None
+    setup: float = 0.0
+    ready: float = 0.0
+    log: str = ""
+
+
+class FleetLauncher:
+    """Launch many VMs concurrently and time each one until it is ready."""
+
+    def __init__(self, specs: list[dict[str, Any]], workers: int, timeout: float, logdir: Path) -> None:
+        self.specs = specs
+        self.workers = workers
+        self.timeout = timeout
+        self.logdir = logdir
+        self._claimed: dict[str, int] = {}  # vmguid -> spec index
+        self._lock = threading.Lock()
+
+    def _claim(self, index: int, vmguid: str) -> bool:
+        with self._lock:
+            return self._claimed.setdefault(vmguid, index) == index
+
+    def launch_one(self, index: int, spec: dict[str, Any]) -> FleetResult:
+        result = FleetResult(spec.get("name") or f"vm{index}")
+        start = perf_counter()
+        q = QEMU()
+        q.claim = functools.partial(self._claim, index)
+        try:
+            q.setting([*spec_to_argv(spec), "--demon"])
+            result.vmprocid, result.ssh_port, result.ip = q.vmprocid, q.ssh_port, q.localip
+            result.setup = perf_counter() - start
+            if q.findProc(q.vmprocid, 0):
+                result.status = "running"
+                return result
+            result.log = str(self.logdir / f"{q.vmprocid}.log")
+            proc = q.spawn(Path(result.log))
+            up = q.findProc(q.vmprocid, self.timeout) and q.wait_qmp(self.timeout)
+            if up:
+                q.register(0)
+            if up and q.cpu_slice:
+                q.pin_threads(self.timeout)
+            if up and q.args.connect == "ssh":
+                q.await_lease(self.timeout)
+                result.ip = q.localip
+                up = q.checkConn(int(self.timeout))
+            result.status = "ready" if up else ("exited" if proc.poll() is not None else "timeout")
+        except DuplicateVM:
+            result.status = "duplicate (same boot image; use vnum)"
+        except Exception as e:
+            result.status = f"error: {e}"
+        finally:
+            result.ready = perf_counter() - start
+        return result
+
+    def run(self) -> list[FleetResult]:
+        self.logdir.mkdir(parents=True, exist_ok=True)
+        if os.getuid():
+            subprocess.run(["sudo", "-v"])  # authenticate once, not from every worker
+        with ThreadPoolExecutor(self.workers, thread_name_prefix="fleet") as pool:
+            return list(pool.map(self.launch_one, range(len(self.specs)), self.specs))
+
+
+def fleet_main(argv: Sequence[str]) -> None:
+    parser = argparse.ArgumentParser(prog="qemu.py fleet", description="Start many VMs from a manifest concurrently")
+    parser.add_argument("manifest", help="YAML or JSON list of VM specs (keys are qemu.py long options)")
+    parser.add_argument("--workers", type=int, default=8, help="Concurrent launches")
+    parser.add_argument("--timeout", type=float, default=120, help="Seconds to wait for each VM to become ready")
+    parser.add_argument("--logdir", default="./fleet-logs", help="Directory for per-VM QEMU output")
+    parser.add_argument("--json", metavar="FILE", help="Write per-VM results as JSON")
+    args = parser.parse_args(argv)
+
+    specs = load_manifest(args.manifest)
+    results = FleetLauncher(specs, args.workers, args.timeout, Path(args.logdir)).run()
+    print_fleet(results)
+    if args.json:
+        Path(args.json).write_text(json.dumps([r.__dict__ for r in results], indent=2))
+
+
+def print_fleet(results: list[FleetResult]) -> None:
+    print(f"{'name':<16}{'vmprocid':<18}{'ssh':>6}  {'ip':<16}{'setup s':>8}{'ready s':>9}  status")
+    for r in results:
+        print(f"{r.name:<16}{r.vmprocid:<18}{r.ssh_port:>6}  {r.ip or '-':<16}{r.setup:>8.2f}{r.ready:>9.2f}  {r.status}")
+
+
+def without_options(argv: Sequence[str], *flags: str) -> list[str]:
+    """Drop ``--flag VALUE`` and ``--flag=VALUE`` occurrences of *flags* from *argv*."""
+    kept: list[str] = []
+    skip = False
+    for token in argv:
+        if skip:
+            skip = False
+        elif token.split("=", 1)[0] in flags:
+            skip = "=" not in token
+        else:
+            kept.append(token)
+    return kept
+
+
+def clones_main(argv: Sequence[str], count: int) -> None:
+    """Create linked clones 1..*count* of one VM and start them concurrently (``--clones K``)."""
+    base = without_options(argv, "--clones", "--vnum")
+    specs = [{"name": f"clone-{n}", "argv": [*base, "--vnum", str(n)]} for n in range(1, count + 1)]
+    print_fleet(FleetLauncher(specs, count, 120, Path("./fleet-logs")).run())
+
+
+# ---------------------------------------------------------------------------
+# storage benchmark (qemu.py bench)
+# ---------------------------------------------------------------------------
+
+BENCH_FORMATS = {"img": "raw", "qcow2": "qcow2", "vhdx": "vhdx"}
+BENCH_FIO_JOB = """\
+[global]
+ioengine=libaio
+direct=1
+time_based=1
+runtime=30
+group_reporting=1
+
+[randread-4k]
+rw=randread
+bs=4k
+iodepth=32
+numjobs=4
+"""
+BENCH_SSH = ["-o", "StrictHostKeyChecking=no", "-o", "UserKnownHostsFile=/dev/null", "-o", "BatchMode=yes", "-o", "ConnectTimeout=5"]
+
+
+@dataclass
+class BenchResult:
+    format: str
+    cache: str
+    aio: str
+    bus: str
+    queues: int
+    status: str = "pending"
+    boot: float = 0.0
+    read_iops: float = 0.0
+    write_iops: float = 0.0
+    read_bw_kib: float = 0.0
+    write_bw_kib: float = 0.0
+    clat_p50_us: float = 0.0
+    clat_p99_us: float = 0.0
+    clat_p999_us: float = 0.0
+
+
+def fio_summary(report: dict[str, Any], result: BenchResult) -> None:
+    """Fold a ``fio --output-format=json`` report into *result*; percentiles come from the busier direction."""
+    job = report["jobs"][0]
+    read, write = job.get("read", {}), job.get("write", {})
+    result.read_iops, result.write_iops = read.get("iops", 0.0), write.get("iops", 0.0)
+    result.read_bw_kib, result.write_bw_kib = read.get("bw", 0), write.get("bw", 0)
+    busiest = read if result.read_iops >= result.write_iops else write
+    pct = busiest.get("clat_ns", {}).get("percentile", {})
+    result.clat_p50_us, result.clat_p99_us, result.clat_p999_us = (pct.get(k, 0) / 1000 for k in ("50.000000", "99.000000", "99.900000"))
+
+
+class BenchRunner:
+    """Boot the guest once per disk configuration and run fio against a scratch disk over SSH.
+
+    Each configuration goes through the normal launcher (``QEMU.setting``), so the drive and
+    device lines are exactly what ``_disk_params``/``configure_nvme`` produce for those options.
+    """
+
+    def __init__(self, args: argparse.Namespace) -> None:
+        self.args = args
+        self.image = str(Path(args.image).resolve())
+        self.scratch = Path(args.scratch).resolve()
+        self.job = Path(args.fio).read_text() if args.fio else BENCH_FIO_JOB
+        self.size = parse_size(args.size)
+
+    def matrix(self) -> Iterator[BenchResult]:
+        for fmt in self.args.format:
+            for bus in self.args.bus:
+                for cache in self.args.cache:
+                    for aio in self.args.aio:
+                        for queues in self.args.queues:
+                            yield BenchResult(fmt, cache, aio, bus, queues)
+
+    def scratch_disk(self, fmt: str) -> Path:
+        """Scratch disk for *fmt*, created once and reused across configurations."""
+        path = self.scratch / f"qbench.{fmt}"
+        if not path.exists():
+            self.scratch.mkdir(parents=True, exist_ok=True)
+            subprocess.run(["qemu-img", "create", "-f", BENCH_FORMATS[fmt], str(path), str(self.size)], check=True, capture_output=True)
+        return path
+
+    def launcher_argv(self, r: BenchResult) -> list[str]:
+        disk = str(self.scratch_disk(r.format))
+        argv = ["--connect", "ssh", "--net", "user", "--noshare", "--nousb", "--demon", "--uname", self.args.uname]
+        if r.bus == "nvme":
+            # an NVMe subsystem with the scratch disk as namespace 1; configure_nvme always uses cache=none
+            return [*argv, "--aio", f"nvme={r.aio}", "--nvme", disk, "--num_queues", str(r.queues or 32), self.image]
+        # the mode under test goes to the scratch disk only, never to the guest's boot image (think cache=unsafe)
+        argv += ["--aio", f"disk={r.aio}", "--disk-bus", r.bus, "--cache", r.cache, "--tune-only", disk]
+        if r.queues:
+            argv += ["--queues", str(r.queues)]
+        return [*argv, self.image, disk]
+
+    def skip_reason(self, r: BenchResult) -> str | None:
+        if r.bus == "nvme" and r.format == "vhdx":
+            return "skipped (nvme namespaces take raw or qcow2)"
+        if r.bus == "nvme" and r.cache != "none":
+            return "skipped (nvme namespaces always use cache=none)"
+        return None
+
+    def ssh(self, q: QEMU, command: list[str], **kwargs: Any) -> subprocess.CompletedProcess[str]:
+        target = ["ssh", *BENCH_SSH, "-p", str(q.ssh_port), f"{self.args.uname}@{q.ssh_host}"]
+        return subprocess.run([*target, shlex.join(command)], capture_output=True, text=True, **kwargs)
+
+    def find_device(self, q: QEMU) -> str | None:
+        """The scratch disk inside the guest: the unpartitioned disk whose size matches exactly."""
+        out = self.ssh(q, ["lsblk", "-J", "-b", "-d", "-p", "-o", "NAME,SIZE,TYPE"], timeout=30)
+        if out.returncode:
+            return None
+        disks = json.loads(out.stdout).get("blockdevices", [])
+        return next((d["name"] for d in disks if d.get("type") == "disk" and int(d.get("size") or 0) == self.size), None)
+
+    def run_one(self, r: BenchResult) -> BenchResult:
+        if reason := self.skip_reason(r):
+            r.status = reason
+            return r
+        start = perf_counter()
+        q = QEMU()
+        proc: subprocess.Popen | None = None
+        try:
+            q.setting(self.launcher_argv(r))
+            if q.findProc(q.vmprocid, 0):
+                r.status = f"error: {q.vmprocid} is already running"
+                return r
+            proc = q.spawn(self.scratch / f"{q.vmprocid}.log")
+            timeout = self.args.timeout
+            up = q.findProc(q.vmprocid, int(timeout)) and q.wait_qmp(timeout) and q.checkConn(int(timeout))
+            # slirp accepts on the forwarded port before sshd is up, so poll a real login
+            up = up and wait_until(lambda: q.qemu_exited() or self.ssh(q, ["true"], timeout=15).returncode == 0, timeout, initial=1.0)
+            if not up or q.qemu_exited():
+                r.status = "exited" if proc.poll() is not None else "timeout"
+                return r
+            r.boot = perf_counter() - start
+            device = self.find_device(q)
+            if not device:
+                r.status = f"error: no {self.size} byte disk in the guest"
+                return r
+            job = f"[global]\nfilename={device}\n\n{self.job}"
+            out = self.ssh(q, ["sudo", "fio", "--output-format=json", "-"], input=job, timeout=timeout + 600)
+            if out.returncode:
+                r.status = f"fio failed: {out.stderr.strip().splitlines()[-1] if out.stderr.strip() else out.returncode}"
+                return r
+            fio_summary(json.loads(out.stdout[out.stdout.index("{") :]), r)
+            r.status = "ok"
+        except Exception as e:
+            r.status = f"error: {e}"
+        finally:
+            if proc is not None:
+                self.shutdown(q, proc)
+        return r
+
+    def shutdown(self, q: QEMU, proc: subprocess.Popen) -> None:
+        try:
+            with QMPClient(q.qmp_sock) as qmp:
+                qmp.execute("quit")
+        except (OSError, QMPError) as e:
+            logger.debug("QMP quit failed: %s", e)
+        try:
+            proc.wait(30)
+        except subprocess.TimeoutExpired:
+            proc.terminate()
+            proc.wait()
+
+    def run(self) -> list[BenchResult]:
+        if os.getuid():
+            subprocess.run(["sudo", "-v"])
+        results = []
+        for r in self.matrix():
+            print(f"{r.format:<6}{r.bus:<11}{r.cache:<13}{r.aio:<9}{r.queues or '-':>3}  ...", end="", flush=True)
+            results.append(self.run_one(r))
+            print(f" {r.status}")
+        return results
+
+
+def write_bench_results(results: list[BenchResult], path: str) -> None:
+    rows = [r.__dict__ for r in results]
+    if Path(path).suffix.lower() == ".csv":
+        with open(path, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=list(rows[0]) if rows else [])
+            writer.writeheader()
+            writer.writerows(rows)
+    else:
+        Path(path).write_text(json.dumps(rows, indent=2))
+
+
+def bench_main(argv: Sequence[str]) -> None:
+    parser = argparse.ArgumentParser(prog="qemu.py bench", description="Run fio in the guest once per disk configuration", formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("image", help="Guest boot image (needs sshd, sudo and fio)")
+    parser.add_argument("--format", nargs="+", default=["qcow2"], choices=list(BENCH_FORMATS), help="Scratch disk formats")
+    parser.add_argument(
+        "--bus", nargs="+", default=["virtio-blk"], choices=list(DISK_BUSES), help="Device the scratch disk is attached as\nnvme = NVMe subsystem namespace via --nvme"
+    )
+    parser.add_argument("--cache", nargs="+", default=["none"], choices=DISK_CACHE_MODES, help="Cache modes")
+    parser.add_argument("--aio", nargs="+", default=["auto"], choices=AIO_ENGINES, help="AIO engines")
+    parser.add_argument("--queues", nargs="+", type=int, default=[0], help="Queue counts (0 = launcher default)")
+    parser.add_argument("--size", default="4G", help="Scratch disk size; the guest finds the disk by this exact size")
+    parser.add_argument("--scratch", default="./bench-disks", help="Directory for scratch disks and QEMU logs")
+    parser.add_argument("--fio", metavar="JOBFILE", help="fio job file (default: 4k random read, QD32 x 4 jobs, 30s)")
+    parser.add_argument("--uname", "-u", default=getpass.getuser(), help="Guest username")
+    parser.add_argument("--timeout", type=float, default=180, help="Seconds to wait for the guest to boot")
+    parser.add_argument("--out", metavar="FILE", help="Write results as CSV (.csv) or JSON")
+    args = parser.parse_args(argv)
+
+    results = BenchRunner(args).run()
+    print(f"\n{'format':<8}{'bus':<11}{'cache':<13}{'aio':<9}{'q':>3}{'r iops':>10}{'w iops':>10}{'r MiB/s':>9}{'w MiB/s':>9}{'p50 us':>9}{'p99 us':>9}{'p99.9 us':>10}  status")
+    for r in results:
+        print(
+            f"{r.format:<8}{r.bus:<11}{r.cache:<13}{r.aio:<9}{r.queues or '-':>3}{r.read_iops:>10.0f}{r.write_iops:>10.0f}"
+            f"{r.read_bw_kib / 1024:>9.1f}{r.write_bw_kib / 1024:>9.1f}{r.clat_p50_us:>9.0f}{r.clat_p99_us:>9.0f}{r.clat_p999_us:>10.0f}  {r.status}"
+        )
+    if args.out:
+        write_bench_results(results, args.out)
+
+
 # ---------------------------------------------------------------------------
 # entry point
 # ---------------------------------------------------------------------------
 
+SUBCOMMANDS: dict[str, Callable[[Sequence[str]], None]] = {
+    "ctl": ctl_main,
+    "fleet": fleet_main,
+    "bench": bench_main,
+    "list": list_main,
+    "status": status_main,
+    "balloon": balloon_main,
+    "ksm": ksm_main,
+}
+
 
 def main() -> None:
+    if len(sys.argv) > 1 and sys.argv[1] in SUBCOMMANDS:
+        SUBCOMMANDS[sys.argv[1]](sys.argv[2:])
+        return
+    if clones := build_parser().parse_known_args()[0].clones:
+        clones_main(sys.argv[1:], clones)
+        return
     q = QEMU()
     q.setting()
     q.run()
 
 
 if __name__ == "__main__":
-    import sys, traceback
+    import traceback
 
     try:
         main()